@@ -1,59 +1,87 @@
+import collections
 import json
-import math 
 import sys
 
 import openreview_lib as orl
+import qa_data_lib
 
 from tqdm import tqdm
 
 WINDOW = 7
-Q = 2124749677  # Is this too big for Python int
+Q = 2124749677  # Prime modulus for the rolling hash
+BASE = 1000003
 
+TOKEN_IDS = {}
 
-def myhash(tokens):
-  tok_str = "".join(tokens)
-  hash_acc = 0
-  for i, ch in enumerate(reversed(tok_str)):
-    hash_acc += math.pow(2, i) * ord(ch)
 
-  return hash_acc % Q
+def get_token_ids(tokens):
+  return [TOKEN_IDS.setdefault(token, len(TOKEN_IDS) + 1) for token in tokens]
 
 
 def get_hashes(tokens):
-  return {i:myhash(tokens[i:i+WINDOW]) for i in range(len(tokens) - WINDOW)}
+  """Rolling hashes of every WINDOW-token window, keyed by start position."""
+  token_ids = get_token_ids(tokens)
+  if len(token_ids) < WINDOW:
+    return {}
+
+  high_power = pow(BASE, WINDOW - 1, Q)
+  hash_acc = 0
+  for token_id in token_ids[:WINDOW]:
+    hash_acc = (hash_acc * BASE + token_id) % Q
+  hashes = {0: hash_acc}
+  for i in range(1, len(token_ids) - WINDOW + 1):
+    hash_acc = ((hash_acc - token_ids[i - 1] * high_power) * BASE
+        + token_ids[i + WINDOW - 1]) % Q
+    hashes[i] = hash_acc
+  return hashes
+
+
+def get_hash_index(hashes):
+  """Maps each window hash to the positions where it occurs, in order."""
+  hash_index = collections.defaultdict(list)
+  for position, hash_value in hashes.items():
+    hash_index[hash_value].append(position)
+  return hash_index
 
 
 def karp_rabin(tokens_1, tokens_2):
-  hashes_1 = get_hashes(tokens_1)
-  hashes_2 = get_hashes(tokens_2)
+  hash_index = get_hash_index(get_hashes(tokens_2))
   results = []
-  for k1, v1 in hashes_1.items():
-    for k2, v2 in hashes_2.items():
-      if v1 == v2:
+  for k1, v1 in get_hashes(tokens_1).items():
+    for k2 in hash_index.get(v1, []):
+      if tokens_1[k1:k1 + WINDOW] == tokens_2[k2:k2 + WINDOW]:
         results.append((k1, k2))
-  return sorted(results)
+  return results  # Sorted, since both positions are visited in order
+
 
+def find_parent(child_node, note_index):
+  if child_node not in note_index:
+    return None
+  parent, forum_head = note_index[child_node]
+  return forum_head, parent
 
-def find_parent(child_node, forum_map):
-  for forum_head, forum in forum_map.items():
-    if child_node in forum.keys():
-      return forum_head, forum[child_node]
 
-  return None
+def get_supernode_index(nodes):
+  """Maps each original note id to the first supernode that includes it."""
+  supernode_index = {}
+  for node in nodes:
+    for note_id in node["included_nodes"]:
+      supernode_index.setdefault(note_id, node)
+  return supernode_index
 
 
-def get_examples_from_nodes_and_map(nodes, forum_map):
+def get_examples_from_nodes_and_map(nodes, note_index):
+  supernode_index = get_supernode_index(nodes)
   chunk_map = {}
   pairs = []
   for node in nodes:
     top_node = node["included_nodes"][0]
-    ancestor_id, parent_id = find_parent(top_node, forum_map)
-    for maybe_parent in nodes:
-      if parent_id in maybe_parent["included_nodes"]:
-        chunk_map[parent_id] = chunk_tokens(maybe_parent["tokens"])
-        chunk_map[top_node] = chunk_tokens(node["tokens"])
-        pairs.append((ancestor_id, top_node, parent_id,))
-        break
+    ancestor_id, parent_id = find_parent(top_node, note_index)
+    parent_node = supernode_index.get(parent_id)
+    if parent_node is not None:
+      chunk_map[parent_id] = chunk_tokens(parent_node["tokens"])
+      chunk_map[top_node] = chunk_tokens(node["tokens"])
+      pairs.append((ancestor_id, top_node, parent_id,))
 
   return pairs, chunk_map
 
@@ -71,31 +99,89 @@ def chunk_tokens(tokens):
   return chunks
 
 
-def get_lcs(chunk1, chunk2, start_indices):
-  current_lcs = []
-  for start1, start2 in start_indices:
-    j = 0
-    while start1 + j < len(chunk1) and start2 + j < len(chunk2):
-      if chunk1[start1:start1+j] == chunk2[start2:start2+j]:
-        j += 1
-      elif j-1 > len(current_lcs):
-        current_lcs = chunk2[start2:start2+j-1]
-  return current_lcs
+def extend_match(chunk1, chunk2, start1, start2, length=WINDOW):
+  """Length of the common run starting at start1 and start2, given that the
+  first length tokens are already known to match."""
+  while (start1 + length < len(chunk1) and start2 + length < len(chunk2)
+      and chunk1[start1 + length] == chunk2[start2 + length]):
+    length += 1
+  return length
+
+
+class ShingleIndex(object):
+  """The window hashes of all chunks of one node, built once per node."""
+
+  def __init__(self, chunks):
+    self.chunks = chunks
+    self.chunk_hashes = [get_hashes(chunk) for chunk in chunks]
+    self.hash_index = collections.defaultdict(list)
+    for j, hashes in enumerate(self.chunk_hashes):
+      for position, hash_value in hashes.items():
+        self.hash_index[hash_value].append((j, position))
+
+  def find_matches(self, other):
+    """Yields (i, k1, j, k2) where window k1 of chunk i of other is equal to
+    window k2 of chunk j of this node, in order of (i, k1)."""
+    for i, hashes in enumerate(other.chunk_hashes):
+      chunk = other.chunks[i]
+      for k1, hash_value in hashes.items():
+        for j, k2 in self.hash_index.get(hash_value, []):
+          if chunk[k1:k1 + WINDOW] == self.chunks[j][k2:k2 + WINDOW]:
+            yield i, k1, j, k2
+
+  def find_spans(self, other):
+    """Maximal common spans between chunks of other and of this node.
+
+    Seeds are visited in order of position in other, so the first seed of a
+    run is its start; later seeds on the same diagonal of the same chunk
+    pair are skipped.
+    """
+    spans = []
+    covered = {}
+    for i, k1, j, k2 in self.find_matches(other):
+      diagonal = (i, j, k1 - k2)
+      if k1 < covered.get(diagonal, -1):
+        continue
+      length = extend_match(other.chunks[i], self.chunks[j], k1, k2)
+      covered[diagonal] = k1 + length
+      spans.append({"child_chunk": i, "child_start": k1,
+        "parent_chunk": j, "parent_start": k2, "length": length})
+    return spans
+
+
+def get_shingle_index(node_id, chunk_map, shingle_indices):
+  if node_id not in shingle_indices:
+    shingle_indices[node_id] = ShingleIndex(chunk_map[node_id])
+  return shingle_indices[node_id]
 
 
 class CommentPair(object):
-  def __init__(self, ancestor, child_node, parent_node, chunk_map):
-    child_chunks = chunk_map[child_node]
-    parent_chunks = chunk_map[parent_node]
+  def __init__(self, ancestor, child_node, parent_node, chunk_map,
+      shingle_indices=None):
+    if shingle_indices is None:
+      shingle_indices = {}
+    child_index = get_shingle_index(child_node, chunk_map, shingle_indices)
+    parent_index = get_shingle_index(parent_node, chunk_map, shingle_indices)
+    child_chunks = child_index.chunks
+    parent_chunks = parent_index.chunks
     child_chunks_mapped = {i:None for i in range(len(child_chunks))}
     parent_chunks_mapped = {i:None for i in range(len(parent_chunks))}
+
+    spans = parent_index.find_spans(child_index)
+
+    # Longest span of each chunk pair
+    longest_spans = {}
+    for span in spans:
+      key = (span["child_chunk"], span["parent_chunk"])
+      if key not in longest_spans or (
+          span["length"] > longest_spans[key]["length"]):
+        longest_spans[key] = span
+
     lcs_map ={}
-    for i, child_chunk in enumerate(child_chunks):
-      for j, parent_chunk in enumerate(parent_chunks):
-        x = karp_rabin(child_chunk, parent_chunk)
-        if x:
-          child_chunks_mapped[i], parent_chunks_mapped[j] = j, i
-          lcs_map[(i,j)] = child_chunk[x[0][0]:x[0][0]+WINDOW] 
+    for (i, j), span in sorted(longest_spans.items()):
+      child_chunks_mapped[i], parent_chunks_mapped[j] = j, i
+      start = span["child_start"]
+      lcs_map[(i,j)] = child_chunks[i][start:start + span["length"]]
     assert len(parent_chunks) == len(parent_chunks_mapped)
     assert len(child_chunks) == len(child_chunks_mapped)
 
@@ -105,29 +191,34 @@ class CommentPair(object):
         "ancestor": ancestor,
         "child_chunks": child_chunks_mapped,
         "parent_chunks": parent_chunks_mapped,
-        "lcs" : list(lcs_map.values())
+        "lcs" : list(lcs_map.values()),
+        "spans": spans
         }
 
-    
-
 
 def main():
 
   forum_info_file, input_file = sys.argv[1:]
 
-  with open(input_file, 'r') as f:
-    nodes = json.loads(f.read())["nodes"]
-  
-  dataset = orl.get_datasets(forum_info_file, debug=False)["train"]
-  pairs, chunk_map = get_examples_from_nodes_and_map(nodes, dataset.forum_map)
-  matches = []
-
-  for ancestor, x, y in tqdm(pairs):
-    cp = CommentPair(ancestor, x, y, chunk_map)
-    matches.append(cp.data)
+  reader = qa_data_lib.QaPairsReader(input_file)
+  dataset = orl.get_datasets(forum_info_file, debug=False)[reader.split]
 
+  # Pairs never cross forums, so matches are computed and written one forum
+  # at a time, in the same format as a single json.dumps of the list
   with open('kr_ouptut.json', 'w') as f:
-    f.write(json.dumps(matches))
+    f.write("[")
+    num_matches = 0
+    for forum in tqdm(reader):
+      pairs, chunk_map = get_examples_from_nodes_and_map(forum["nodes"],
+          dataset.note_index)
+      shingle_indices = {}
+      for ancestor, x, y in pairs:
+        cp = CommentPair(ancestor, x, y, chunk_map, shingle_indices)
+        if num_matches:
+          f.write(", ")
+        f.write(json.dumps(cp.data))
+        num_matches += 1
+    f.write("]")
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,240 @@
+import collections
+import concurrent.futures
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import conll_lib
+
+# Sent as its own paragraph between documents in a batch; CoreNLP keeps it as
+# a one-token sentence that the output is split on afterwards.
+DOC_SEPARATOR = "DOCSEPARATORXYZ"
+SEPARATOR_TEXT = "\n\n" + DOC_SEPARATOR + "\n\n"
+
+CACHE_PATH_VAR = "REVIEW_ANNOTATION_CACHE"
+DEFAULT_CACHE_PATH = ".annotation_cache.sqlite"
+MAX_CACHE_BYTES = 2 << 30
+
+# Set by the client on every request, so not part of the pipeline's identity
+REQUEST_PROPERTIES = ["annotators", "inputFormat", "outputFormat", "serializer"]
+
+
+def make_batches(items, batch_size, max_chars):
+  """Groups (key, text) pairs into batches bounded in count and characters."""
+  batch = []
+  batch_chars = 0
+  for key, text in items:
+    if batch and (len(batch) == batch_size
+        or batch_chars + len(text) > max_chars):
+      yield batch
+      batch = []
+      batch_chars = 0
+    batch.append((key, text))
+    batch_chars += len(text) + len(SEPARATOR_TEXT)
+  if batch:
+    yield batch
+
+
+def is_separator_sentence(sentence):
+  return len(sentence) == 1 and sentence[0].split()[1] == DOC_SEPARATOR
+
+
+def split_conll_output(conll_text):
+  """Splits CoNLL output for a batch into one CoNLL string per document."""
+  documents = [[]]
+  sentence = []
+  for line in conll_text.split("\n") + [""]:
+    if line.strip():
+      sentence.append(line)
+    elif sentence:
+      if is_separator_sentence(sentence):
+        documents.append([])
+      else:
+        documents[-1].append(sentence)
+      sentence = []
+
+  return ["".join("\n".join(sentence) + "\n\n" for sentence in document)
+      for document in documents]
+
+
+class AnnotationEngine(object):
+  """Annotates many texts using a pool of CoreNLP clients.
+
+  Texts are sent in batches joined by a separator paragraph, and up to
+  requests_per_client batches are in flight per client. Each client should
+  talk to a different server endpoint. Texts found in the cache, if one is
+  given, are not sent at all.
+  """
+
+  def __init__(self, clients, batch_size=50, max_chars=50000,
+      requests_per_client=2, cache=None):
+    self.clients = list(clients)
+    self.batch_size = batch_size
+    self.max_chars = max_chars
+    self.max_in_flight = len(self.clients) * requests_per_client
+    self.cache = cache
+    # Built once, since reading a client's properties is not safe while it
+    # is annotating in another thread
+    self.cached_clients = [None if cache is None
+        else CachedClient(client, cache) for client in self.clients]
+
+  def _annotate_batch(self, client_index, batch):
+    client = self.clients[client_index]
+    cached_client = self.cached_clients[client_index]
+    documents = {}
+    if cached_client is not None:
+      for key, text in batch:
+        document = cached_client.lookup(text)
+        if document is not None:
+          documents[key] = document
+
+    misses = [(key, text) for key, text in batch if key not in documents]
+    if misses:
+      output = client.annotate(SEPARATOR_TEXT.join(text for _, text in misses))
+      new_documents = split_conll_output(output)
+      if len(new_documents) != len(misses):
+        # The separator was not kept as its own sentence; fall back to one
+        # request per text for this batch.
+        new_documents = [client.annotate(text) for _, text in misses]
+      for (key, text), document in zip(misses, new_documents):
+        documents[key] = document
+        if cached_client is not None:
+          cached_client.store(text, document)
+    return [(key, documents[key]) for key, _ in batch]
+
+  def annotate_all(self, items):
+    """Yields (key, CoNLL text) for each (key, text) pair, in input order."""
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=self.max_in_flight) as executor:
+      pending = collections.deque()
+      for i, batch in enumerate(
+          make_batches(items, self.batch_size, self.max_chars)):
+        pending.append(executor.submit(self._annotate_batch,
+          i % len(self.clients), batch))
+        if len(pending) >= self.max_in_flight:
+          yield from pending.popleft().result()
+      while pending:
+        yield from pending.popleft().result()
+
+
+class AnnotationCache(object):
+  """Annotation outputs stored in a SQLite file, keyed by request hash.
+
+  Entries are evicted least recently used first once their total size goes
+  over max_bytes.
+  """
+
+  def __init__(self, path, max_bytes=MAX_CACHE_BYTES):
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, timeout=60,
+        check_same_thread=False, isolation_level=None)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.execute("CREATE TABLE IF NOT EXISTS annotations "
+        "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)")
+    self.connection.execute(
+        "CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used)")
+    self.total_bytes = self._get_total_bytes()
+
+  def _get_total_bytes(self):
+    return self.connection.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM annotations").fetchone()[0]
+
+  def get(self, key):
+    with self.lock:
+      row = self.connection.execute(
+          "SELECT value FROM annotations WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      self.connection.execute("UPDATE annotations SET used = ? WHERE key = ?",
+          (time.time(), key))
+      return row[0]
+
+  def put(self, key, value):
+    size = len(value)
+    with self.lock:
+      self.connection.execute("INSERT OR REPLACE INTO annotations "
+          "VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+      self.total_bytes += size
+      if self.total_bytes > self.max_bytes:
+        self._evict()
+
+  def _evict(self):
+    # Other processes may share the file, so recount before evicting
+    self.total_bytes = self._get_total_bytes()
+    excess = self.total_bytes - self.max_bytes
+    if excess <= 0:
+      return
+    evicted = []
+    for key, size in self.connection.execute(
+        "SELECT key, size FROM annotations ORDER BY used"):
+      if excess <= 0:
+        break
+      evicted.append((key,))
+      excess -= size
+      self.total_bytes -= size
+    self.connection.executemany("DELETE FROM annotations WHERE key = ?",
+        evicted)
+
+  def close(self):
+    self.connection.close()
+
+
+class CachedClient(object):
+  """A CoreNLP client that looks up each text in an AnnotationCache first.
+
+  The cache key covers the annotators, properties and output format the
+  client was configured with, as well as the text.
+  """
+
+  def __init__(self, client, cache):
+    self.client = client
+    self.cache = cache
+    properties = {key: value
+        for key, value in client.default_properties.items()
+        if key not in REQUEST_PROPERTIES}
+    self.output_format = client.default_output_format
+    self.signature = (" ".join(client.default_annotators),
+        json.dumps(properties, sort_keys=True), self.output_format)
+
+  def _get_key(self, text):
+    return conll_lib.get_text_hash(*self.signature, text)
+
+  def lookup(self, text):
+    """The cached output for text, or None."""
+    cached = self.cache.get(self._get_key(text))
+    if cached is not None and self.output_format == "json":
+      return json.loads(cached)
+    return cached
+
+  def store(self, text, output):
+    self.cache.put(self._get_key(text),
+        json.dumps(output) if self.output_format == "json" else output)
+
+  def annotate(self, text):
+    output = self.lookup(text)
+    if output is None:
+      output = self.client.annotate(text)
+      self.store(text, output)
+    return output
+
+
+def get_cache(path=None):
+  """The annotation cache at path, or at $REVIEW_ANNOTATION_CACHE.
+
+  Returns None if caching is turned off by setting the variable to "".
+  """
+  if path is None:
+    path = os.environ.get(CACHE_PATH_VAR, DEFAULT_CACHE_PATH)
+  if not path:
+    return None
+  return AnnotationCache(path)
+
+
+def get_cached_client(client, cache):
+  if cache is None:
+    return client
+  return CachedClient(client, cache)
@@ -0,0 +1,67 @@
+"""Compares the hash-join matcher with the old nested loop on large pairs.
+
+Takes the same inputs as analysis/karp_rabin.py and times both matchers over
+all chunk pairs of the reply/parent pairs with the most tokens. Run from the
+repository root:
+
+  python -m benchmarks.karp_rabin_join splits/iclr19_split.json qa.jsonl [n]
+"""
+import sys
+import time
+
+from analysis import karp_rabin as kr
+import openreview_lib as orl
+import qa_data_lib
+
+
+def nested_loop_karp_rabin(tokens_1, tokens_2):
+  """The previous matcher, which compares every pair of window hashes."""
+  hashes_1 = kr.get_hashes(tokens_1)
+  hashes_2 = kr.get_hashes(tokens_2)
+  results = []
+  for k1, v1 in hashes_1.items():
+    for k2, v2 in hashes_2.items():
+      if (v1 == v2
+          and tokens_1[k1:k1 + kr.WINDOW] == tokens_2[k2:k2 + kr.WINDOW]):
+        results.append((k1, k2))
+  return sorted(results)
+
+
+def time_matcher(matcher, chunk_pairs):
+  start = time.perf_counter()
+  results = [matcher(child_chunk, parent_chunk)
+      for child_chunk, parent_chunk in chunk_pairs]
+  return time.perf_counter() - start, results
+
+
+def main():
+  forum_info_file, input_file = sys.argv[1:3]
+  num_pairs = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+  reader = qa_data_lib.QaPairsReader(input_file)
+  nodes = [node for forum in reader for node in forum["nodes"]]
+  dataset = orl.get_datasets(forum_info_file)[reader.split]
+  pairs, chunk_map = kr.get_examples_from_nodes_and_map(nodes,
+      dataset.note_index)
+
+  def num_tokens(pair):
+    _, child, parent = pair
+    return sum(len(chunk) for chunk in chunk_map[child] + chunk_map[parent])
+
+  print("child\tparent\ttokens\tnested_ms\tjoin_ms\tspeedup")
+  for pair in sorted(pairs, key=num_tokens, reverse=True)[:num_pairs]:
+    _, child, parent = pair
+    chunk_pairs = [(child_chunk, parent_chunk)
+        for child_chunk in chunk_map[child]
+        for parent_chunk in chunk_map[parent]]
+    nested_time, nested_results = time_matcher(nested_loop_karp_rabin,
+        chunk_pairs)
+    join_time, join_results = time_matcher(kr.karp_rabin, chunk_pairs)
+    assert nested_results == join_results
+    print("{0}\t{1}\t{2}\t{3:.1f}\t{4:.1f}\t{5:.1f}".format(child, parent,
+      num_tokens(pair), nested_time * 1e3, join_time * 1e3,
+      nested_time / max(join_time, 1e-9)))
+
+
+if __name__ == "__main__":
+  main()
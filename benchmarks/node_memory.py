@@ -0,0 +1,75 @@
+"""Measures the memory held by the NoteNode and SuperNode maps of a dataset.
+
+Reads forums from a snapshot, so set $REVIEW_SNAPSHOT_DIR (and $REVIEW_OFFLINE
+to avoid the network). Run from the repository root:
+
+  python -m benchmarks.node_memory splits/iclr19_split.json
+"""
+import sys
+import tracemalloc
+
+import create_qa_data
+import openreview_lib as orl
+
+
+class DictNoteNode(object):
+  """The previous NoteNode, with a __dict__ and an eager creation_time."""
+
+  def __init__(self, note, reply_to=None):
+    self.note_id = note.id
+    self.tcdate = note.tcdate
+    self.title = note.content["title"]
+    self.text = orl.get_text_if_any(note)
+    self.author = orl.get_author(note.signatures)
+    self.creation_time = orl.get_strdate(note)
+    self.replies = []
+    self.reply_to_id = note.replyto
+
+
+def measure(build):
+  tracemalloc.start()
+  result = build()
+  size, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return result, size
+
+
+def build_supernode_maps(dataset):
+  supernode_maps = []
+  for forum_id, structure in dataset.forum_map.items():
+    mini_node_map = create_qa_data.get_mini_node_map(
+        dataset.forum_trees[forum_id], dataset.node_map)
+    supernode_maps.append(create_qa_data.restructure(structure,
+      mini_node_map)[1])
+  return supernode_maps
+
+
+def main():
+  dataset_file = sys.argv[1]
+
+  for split, dataset in orl.get_datasets(dataset_file).items():
+    assert dataset.snapshot is not None, "Set $REVIEW_SNAPSHOT_DIR"
+    notes = [note
+        for forum_id in dataset.forum_map
+        for note in dataset.snapshot.get_notes(forum_id)]
+    text_bytes = sum(len(node.text.encode("utf-8"))
+        for node in dataset.node_map.values())
+
+    _, dict_size = measure(lambda: [DictNoteNode(note) for note in notes])
+    _, slot_size = measure(lambda: [orl.NoteNode(note) for note in notes])
+    supernode_maps, supernode_size = measure(
+        lambda: build_supernode_maps(dataset))
+    num_supernodes = sum(len(m) for m in supernode_maps)
+
+    print(split)
+    print("  notes: {0}, text: {1:.1f} MB".format(len(notes), text_bytes / 1e6))
+    print("  dict NoteNodes: {0:.1f} MB ({1:.0f} B/node)".format(
+      dict_size / 1e6, dict_size / len(notes)))
+    print("  slotted NoteNodes: {0:.1f} MB ({1:.0f} B/node)".format(
+      slot_size / 1e6, slot_size / len(notes)))
+    print("  SuperNodes: {0:.1f} MB ({1:.0f} B/node)".format(
+      supernode_size / 1e6, supernode_size / max(1, num_supernodes)))
+
+
+if __name__ == "__main__":
+  main()
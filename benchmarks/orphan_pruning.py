@@ -0,0 +1,72 @@
+"""Times orphan pruning on synthetic forums of 10 to 10,000 notes.
+
+Run from the repository root: python -m benchmarks.orphan_pruning
+"""
+import collections
+import random
+import timeit
+
+import openreview_lib as orl
+
+FORUM_SIZES = [10, 100, 1000, 10000]
+ORPHAN_RATE = 0.02
+
+
+def make_forum(num_notes, rng):
+  """A random reply tree, with some replies to notes missing from the forum."""
+  parents = {"root": None}
+  note_ids = ["root"]
+  for i in range(num_notes - 1):
+    note_id = "note{0}".format(i)
+    if rng.random() < ORPHAN_RATE:
+      parents[note_id] = "missing{0}".format(i)
+    else:
+      parents[note_id] = rng.choice(note_ids)
+    note_ids.append(note_id)
+  items = list(parents.items())
+  rng.shuffle(items)
+  return dict(items)
+
+
+def quadratic_non_orphans(parents):
+  """The previous implementation, kept for comparison."""
+  children = collections.defaultdict(list)
+  for child, parent in parents.items():
+    children[parent].append(child)
+
+  descendants = sum(children.values(), [])
+  ancestors = children.keys()
+  nonchildren = set(ancestors) - set(descendants)
+  orphans = sorted(list(nonchildren - set([None])))
+
+  while orphans:
+    current_orphan = orphans.pop()
+    orphans += children[current_orphan]
+    del children[current_orphan]
+
+  new_parents = {}
+  for parent, child_list in children.items():
+    for child in child_list:
+      new_parents[child] = parent
+  return new_parents
+
+
+def main():
+  rng = random.Random(0)
+  print("notes\tlinear_ms\tus_per_note\tquadratic_ms")
+  for num_notes in FORUM_SIZES:
+    parents = make_forum(num_notes, rng)
+    new_parents, _, _ = orl.get_non_orphans(parents, "root")
+    assert new_parents == quadratic_non_orphans(parents)
+
+    number = max(1, 10000 // num_notes)
+    linear = min(timeit.repeat(lambda: orl.get_non_orphans(parents, "root"),
+      number=number, repeat=3)) / number
+    quadratic = min(timeit.repeat(lambda: quadratic_non_orphans(parents),
+      number=number, repeat=3)) / number
+    print("{0}\t{1:.3f}\t{2:.3f}\t{3:.3f}".format(num_notes, linear * 1e3,
+      linear * 1e6 / num_notes, quadratic * 1e3))
+
+
+if __name__ == "__main__":
+  main()
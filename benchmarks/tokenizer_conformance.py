@@ -0,0 +1,81 @@
+"""Compares the fast tokenizer with CoreNLP on a sample of notes.
+
+Token and sentence boundaries are compared by character offsets, and
+question sentences (those ending in "?") by their spans, each as precision
+and recall of the fast tokenizer against CoreNLP. Needs a CoreNLP server
+that the client can start. Run from the repository root:
+
+  python -m benchmarks.tokenizer_conformance splits/iclr19_split.json [n]
+"""
+import random
+import sys
+import time
+
+import create_qa_data
+import openreview_lib as orl
+import tokenize_lib
+
+
+def get_boundaries(annotation):
+  tokens = set()
+  sentences = set()
+  questions = set()
+  for sentence in annotation["sentences"]:
+    if not sentence["tokens"]:
+      continue
+    spans = [(token["characterOffsetBegin"], token["characterOffsetEnd"])
+        for token in sentence["tokens"]]
+    tokens.update(spans)
+    sentence_span = (spans[0][0], spans[-1][1])
+    sentences.add(sentence_span)
+    if sentence["tokens"][-1]["word"] == "?":
+      questions.add(sentence_span)
+  return tokens, sentences, questions
+
+
+def time_annotate(client, texts):
+  start = time.perf_counter()
+  annotations = [client.annotate(text) for text in texts]
+  return time.perf_counter() - start, annotations
+
+
+def main():
+  dataset_file = sys.argv[1]
+  num_notes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+  texts = [node.text
+      for dataset in orl.get_datasets(dataset_file).values()
+      for node in dataset.node_map.values()
+      if node.text.strip()]
+  texts = random.Random(0).sample(texts, min(num_notes, len(texts)))
+
+  fast_time, fast_annotations = time_annotate(tokenize_lib.FastTokenizer(),
+      texts)
+  with tokenize_lib.get_tokenize_client(tokenize_lib.CORENLP,
+      annotators=create_qa_data.ANNOTATORS,
+      properties=create_qa_data.PROPERTIES, output_format="json") as client:
+    corenlp_time, corenlp_annotations = time_annotate(client, texts)
+
+  names = ["tokens", "sentences", "questions"]
+  matched = [0] * len(names)
+  fast_counts = [0] * len(names)
+  corenlp_counts = [0] * len(names)
+  for fast, reference in zip(fast_annotations, corenlp_annotations):
+    for i, (fast_set, reference_set) in enumerate(
+        zip(get_boundaries(fast), get_boundaries(reference))):
+      matched[i] += len(fast_set & reference_set)
+      fast_counts[i] += len(fast_set)
+      corenlp_counts[i] += len(reference_set)
+
+  print("unit\tcorenlp\tfast\tprecision\trecall")
+  for i, name in enumerate(names):
+    print("{0}\t{1}\t{2}\t{3:.4f}\t{4:.4f}".format(name, corenlp_counts[i],
+      fast_counts[i], matched[i] / max(fast_counts[i], 1),
+      matched[i] / max(corenlp_counts[i], 1)))
+  print("notes\tcorenlp_s\tfast_s\tspeedup")
+  print("{0}\t{1:.2f}\t{2:.2f}\t{3:.1f}".format(len(texts), corenlp_time,
+    fast_time, corenlp_time / max(fast_time, 1e-9)))
+
+
+if __name__ == "__main__":
+  main()
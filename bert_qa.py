@@ -31,33 +31,30 @@ def find_answer(question, passage, tokenizer, model):
   return ' '.join(tokens[answer_start:answer_end+1])
 
 TOKEN_IDX = 4
+CONLL_PREFIX = "./const/iclr19/train/"
 
-def get_questions_from_comment(note_id):
-  filename = "./const/iclr19/train/" + note_id + ".txt"
-  try:
-    listified_dataset = conll_lib.listify_conll_dataset(filename)
-  except FileNotFoundError:
+def get_questions_from_comment(note_id, conll_reader):
+  if note_id not in conll_reader:
     return []
 
   questions = []
-  for document in listified_dataset:
-    for sentence in document:
-      last_token = sentence[-1]
-      if last_token[0].startswith("#"): # This is a begin or end
-        continue
-      if last_token[TOKEN_IDX] == "?":
-        questions.append(" ".join([token[TOKEN_IDX] for token in sentence]))
+  for sentence in conll_reader.get_document(note_id):
+    last_token = sentence[-1]
+    if last_token[0].startswith("#"): # This is a begin or end
+      continue
+    if last_token[TOKEN_IDX] == "?":
+      questions.append(" ".join([token[TOKEN_IDX] for token in sentence]))
      
   return questions
 
 
-def create_qa_examples(dataset):
+def create_qa_examples(dataset, conll_reader):
   qa_examples = []
   for root, forum_structure in dataset.forum_map.items():
     for child, parent in forum_structure.items():
       if parent is None:
         continue
-      questions = get_questions_from_comment(parent)
+      questions = get_questions_from_comment(parent, conll_reader)
       qa_examples += [
           (parent, child, question, dataset.node_map[child].text)
           for question in questions]
@@ -69,7 +66,8 @@ def main():
   dataset_file = sys.argv[1]
 
   datasets = orl.get_datasets(dataset_file)
-  qa_examples = create_qa_examples(datasets["train"])
+  with conll_lib.ShardedConllReader(CONLL_PREFIX) as conll_reader:
+    qa_examples = create_qa_examples(datasets["train"], conll_reader)
 
   model = BertForQuestionAnswering.from_pretrained('bert-large-uncased-whole-word-masking-finetuned-squad')
   tokenizer = BertTokenizer.from_pretrained('bert-large-uncased-whole-word-masking-finetuned-squad')
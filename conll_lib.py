@@ -1,20 +1,409 @@
-def listify_conll_dataset(filename):
-  with open(filename, 'r') as f:
-    lines = f.readlines()
-    return listify_conll_lines(lines)
+import array
+import glob
+import gzip
+import hashlib
+import json
+import mmap
+import numpy as np
+import os
+import sys
 
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+SHARD_FILENAME = "shard-{0:05d}.conll"
+SHARD_SIZE = 256 << 20
+WRITE_BUFFER_SIZE = 1 << 20
 
-def listify_conll_lines(lines):
- 
-  dataset = []
+
+def get_text_hash(*fields):
+  return hashlib.sha1("\t".join(fields).encode("utf-8")).hexdigest()
+
+
+class ConllManifest(object):
+  """Records the shard, byte span and source text hash of each document.
+
+  Documents may be appended more than once as their source text changes; the
+  manifest always points at the latest copy.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.documents = {}
+    if os.path.exists(path):
+      with open(path, 'r') as f:
+        self.documents = json.loads(f.read())["documents"]
+
+  def __contains__(self, doc_id):
+    return doc_id in self.documents
+
+  def is_current(self, doc_id, text_hash):
+    entry = self.documents.get(doc_id)
+    return entry is not None and entry["hash"] == text_hash
+
+  def add(self, doc_id, text_hash, shard, offset, length):
+    self.documents[doc_id] = {"hash": text_hash, "shard": shard,
+        "offset": offset, "length": length}
+
+  def clear(self):
+    self.documents = {}
+
+  def retain(self, doc_ids):
+    self.documents = {doc_id: entry
+        for doc_id, entry in self.documents.items() if doc_id in doc_ids}
+
+  def discard_beyond(self, shard_sizes):
+    """Forgets documents that are not fully contained in their shard."""
+    self.documents = {doc_id: entry
+        for doc_id, entry in self.documents.items()
+        if entry["offset"] + entry["length"] <= shard_sizes.get(
+          entry["shard"], 0)}
+
+  def get_last_shard(self):
+    return max((entry["shard"] for entry in self.documents.values()),
+        default=0)
+
+  def get_end(self, shard):
+    return max((entry["offset"] + entry["length"]
+      for entry in self.documents.values() if entry["shard"] == shard),
+      default=0)
+
+  def save(self):
+    temp_path = self.path + ".tmp"
+    with open(temp_path, 'w') as f:
+      f.write(json.dumps({"documents": self.documents}))
+    os.replace(temp_path, self.path)
+
+
+def get_shard_paths(prefix):
+  """Maps shard number to path for the shards that exist under prefix."""
+  shard_paths = {}
+  for path in glob.glob(prefix + SHARD_FILENAME.replace("{0:05d}", "*")):
+    shard_name = os.path.basename(path)
+    shard_paths[int(shard_name.split("-")[1].split(".")[0])] = path
+  return shard_paths
+
+
+class ShardedConllWriter(object):
+  """Appends CoNLL documents to a few large shards indexed by a manifest.
+
+  In incremental mode, documents recorded in an existing manifest are kept
+  and anything written after the manifest was last saved is discarded.
+  """
+
+  def __init__(self, prefix, incremental=False, shard_size=SHARD_SIZE):
+    self.prefix = prefix
+    self.shard_size = shard_size
+    self.manifest = ConllManifest(prefix + MANIFEST_FILENAME)
+    shard_paths = get_shard_paths(prefix)
+    if incremental:
+      self.manifest.discard_beyond({shard: os.path.getsize(path)
+        for shard, path in shard_paths.items()})
+    else:
+      self.manifest.clear()
+
+    self.shard = self.manifest.get_last_shard()
+    for shard, path in shard_paths.items():
+      if shard > self.shard:
+        os.remove(path)
+    self._open_shard()
+    self.shard_file.truncate(self.manifest.get_end(self.shard))
+    self.offset = self.manifest.get_end(self.shard)
+
+  def _open_shard(self):
+    self.shard_file = open(self.prefix + SHARD_FILENAME.format(self.shard),
+        'ab', buffering=WRITE_BUFFER_SIZE)
+
+  def is_current(self, doc_id, text_hash):
+    return self.manifest.is_current(doc_id, text_hash)
+
+  def retain(self, doc_ids):
+    self.manifest.retain(doc_ids)
+
+  def write(self, doc_id, text_hash, text):
+    if self.offset >= self.shard_size:
+      self.shard_file.close()
+      self.shard += 1
+      self.offset = 0
+      self._open_shard()
+    data = text.encode("utf-8")
+    self.shard_file.write(data)
+    self.manifest.add(doc_id, text_hash, self.shard, self.offset, len(data))
+    self.offset += len(data)
+
+  def save(self):
+    self.shard_file.flush()
+    self.manifest.save()
+
+  def close(self):
+    self.save()
+    self.shard_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+class ShardedConllReader(object):
+  """Random access by document id to CoNLL documents in sharded files."""
+
+  def __init__(self, prefix):
+    self.prefix = prefix
+    self.manifest = ConllManifest(prefix + MANIFEST_FILENAME)
+    self.shard_files = {}
+
+  def __contains__(self, doc_id):
+    return doc_id in self.manifest
+
+  def get_doc_ids(self):
+    return list(self.manifest.documents)
+
+  def get_text(self, doc_id):
+    entry = self.manifest.documents[doc_id]
+    shard = entry["shard"]
+    if shard not in self.shard_files:
+      self.shard_files[shard] = open(
+          self.prefix + SHARD_FILENAME.format(shard), 'rb')
+    shard_file = self.shard_files[shard]
+    shard_file.seek(entry["offset"])
+    return shard_file.read(entry["length"]).decode("utf-8")
+
+  def get_document(self, doc_id):
+    document, = iter_conll_documents(self.get_text(doc_id).split("\n"))
+    return document
+
+  def close(self):
+    for shard_file in self.shard_files.values():
+      shard_file.close()
+    self.shard_files = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def split_fields(line):
+  if "\t" in line:
+    return line.strip().split("\t")
+  else:
+    return line.strip().split()
+
+
+def get_doc_id(begin_fields):
+  return begin_fields[-1].strip("()")
+
+
+def build_conll_index(buf):
+  """Finds the byte span of every sentence and the sentences of each document.
+
+  As in listify_conll_lines, the #begin and #end lines of a document count as
+  sentences of their own.
+  """
+  sentence_starts = array.array('q')
+  sentence_ends = array.array('q')
+  document_sentences = array.array('q', [0])
+  sentence_start = None
+  sentence_end = None
+
+  def end_sentence():
+    if sentence_start is not None:
+      sentence_starts.append(sentence_start)
+      sentence_ends.append(sentence_end)
+
+  position = 0
+  size = len(buf)
+  while position < size:
+    newline = buf.find(b"\n", position)
+    line_end = size if newline == -1 else newline
+    line = buf[position:line_end]
+    if line.startswith(b"#begin") or line.startswith(b"#end"):
+      end_sentence()
+      sentence_start = None
+      sentence_starts.append(position)
+      sentence_ends.append(line_end)
+      if line.startswith(b"#end"):
+        document_sentences.append(len(sentence_starts))
+    elif not line.strip():
+      end_sentence()
+      sentence_start = None
+    else:
+      if sentence_start is None:
+        sentence_start = position
+      sentence_end = line_end
+    position = line_end + 1
+
+  return sentence_starts, sentence_ends, document_sentences
+
+
+class ConllSentenceView(object):
+  """A sentence whose lines are split into fields only when accessed."""
+
+  def __init__(self, buf, start, end):
+    self.buf = buf
+    self.start = start
+    self.end = end
+    self._tokens = None
+
+  def _get_tokens(self):
+    if self._tokens is None:
+      self._tokens = [split_fields(line) for line in
+          self.buf[self.start:self.end].decode("utf-8").split("\n")]
+    return self._tokens
+
+  def __len__(self):
+    return len(self._get_tokens())
+
+  def __getitem__(self, i):
+    return self._get_tokens()[i]
+
+  def __iter__(self):
+    return iter(self._get_tokens())
+
+
+class ConllDocumentView(object):
+  """The sentences of one document, as in listify_conll_lines."""
+
+  def __init__(self, conll_file, first_sentence, end_sentence):
+    self.conll_file = conll_file
+    self.first_sentence = first_sentence
+    self.end_sentence = end_sentence
+
+  def get_doc_id(self):
+    return get_doc_id(self[0][0])
+
+  def __len__(self):
+    return self.end_sentence - self.first_sentence
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    return self.conll_file.get_sentence(self.first_sentence + i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+
+class MappedConllFile(object):
+  """Memory-mapped CoNLL file with lazy document and sentence views.
+
+  The sentence and document offsets are cached next to the file and rebuilt
+  when the file's size or modification time changes.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.file = open(filename, 'rb')
+    stat = os.fstat(self.file.fileno())
+    if stat.st_size:
+      self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self.buf = b""
+    header = [INDEX_VERSION, stat.st_size, stat.st_mtime_ns]
+    index = self._load_index(header)
+    if index is None:
+      index = build_conll_index(self.buf)
+      self._save_index(header, index)
+    self.sentence_starts, self.sentence_ends, self.document_sentences = index
+    self._doc_id_map = None
+
+  def _load_index(self, header):
+    """The cached index, or None if it is missing, stale or malformed."""
+    try:
+      with open(self.filename + INDEX_SUFFIX, 'rb') as f:
+        data = f.read()
+    except OSError:
+      return None
+    values = array.array('q')
+    if len(data) % values.itemsize:
+      return None
+    values.frombytes(data)
+    if len(values) < 5 or values[:3].tolist() != header:
+      return None
+    num_sentences, num_documents = values[3], values[4]
+    if (num_sentences < 0 or num_documents < 0
+        or len(values) != 5 + 2 * num_sentences + num_documents + 1):
+      return None
+    sentence_starts = values[5:5 + num_sentences]
+    sentence_ends = values[5 + num_sentences:5 + 2 * num_sentences]
+    document_sentences = values[5 + 2 * num_sentences:]
+    return sentence_starts, sentence_ends, document_sentences
+
+  def _save_index(self, header, index):
+    sentence_starts, sentence_ends, document_sentences = index
+    values = array.array('q', header + [
+      len(sentence_starts), len(document_sentences) - 1])
+    for column in index:
+      values.extend(column)
+    index_path = self.filename + INDEX_SUFFIX
+    temp_path = index_path + ".tmp"
+    try:
+      with open(temp_path, 'wb') as f:
+        f.write(values.tobytes())
+      os.replace(temp_path, index_path)
+    except OSError:
+      pass  # The index is only a cache
+
+  def __len__(self):
+    return len(self.document_sentences) - 1
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    return ConllDocumentView(self, self.document_sentences[i],
+        self.document_sentences[i + 1])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def get_sentence(self, i):
+    return ConllSentenceView(self.buf, self.sentence_starts[i],
+        self.sentence_ends[i])
+
+  def get_document(self, doc_id):
+    if self._doc_id_map is None:
+      self._doc_id_map = {document.get_doc_id(): i
+          for i, document in enumerate(self)}
+    return self[self._doc_id_map[doc_id]]
+
+  def close(self):
+    if isinstance(self.buf, mmap.mmap):
+      self.buf.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def iter_file_lines(filename):
+  """Yields the lines of a file, a gzipped file (*.gz), or stdin ("-")."""
+  if filename == "-":
+    yield from sys.stdin
+    return
+  opener = gzip.open if filename.endswith(".gz") else open
+  with opener(filename, 'rt') as f:
+    yield from f
+
+
+def iter_conll_documents(lines):
+  """Yields the documents of a CoNLL file one at a time."""
   curr_doc = []
   curr_sent = []
 
   for line in lines:
-    if "\t" in line:
-      fields = line.strip().split("\t")
-    else:
-      fields = line.strip().split()
+    fields = split_fields(line)
 
     if line.startswith("#begin"):
       assert not curr_doc
@@ -22,7 +411,7 @@ def listify_conll_lines(lines):
 
     elif line.startswith("#end"):
       curr_doc.append([fields])
-      dataset.append(curr_doc)
+      yield curr_doc
       curr_doc = []
 
     elif not line.strip():
@@ -33,25 +422,135 @@ def listify_conll_lines(lines):
     else: # Empty line signifies the end of a sentence
       curr_sent.append(fields)
 
-  return dataset
-
 
-def listify_non_doc_lines(lines):
-  document = []
+def iter_non_doc_sentences(lines):
+  """Yields the sentences of CoNLL lines without document markers."""
   curr_sent = []
   for line in lines:
-    if "\t" in line:
-      fields = line.strip().split("\t")
-    else:
-      fields = line.strip().split()
-
     if not line.strip():
       if curr_sent:
-        document.append(curr_sent)
+        yield curr_sent
         curr_sent = []
 
     else: # Empty line signifies the end of a sentence
-      curr_sent.append(fields)
-  return document
+      curr_sent.append(split_fields(line))
+
+
+def listify_conll_dataset(filename):
+  return list(iter_conll_documents(iter_file_lines(filename)))
+
+
+def listify_conll_lines(lines):
+  return list(iter_conll_documents(lines))
+
+
+def listify_non_doc_lines(lines):
+  return list(iter_non_doc_sentences(lines))
+
+
+class TokenStore(object):
+  """Columnar storage for the tokens of many CoNLL documents.
+
+  Selected columns (field indices) are stored as integer arrays of ids into a
+  shared interned vocabulary. Sentence i spans tokens
+  sentence_offsets[i]:sentence_offsets[i + 1], and document j spans sentences
+  document_offsets[j]:document_offsets[j + 1].
+  """
+
+  def __init__(self, column_indices):
+    self.column_indices = list(column_indices)
+    self.vocab = []
+    self.vocab_index = {}
+    self.doc_ids = []
+    self._columns = {i: array.array('i') for i in self.column_indices}
+    self._sentence_offsets = array.array('q', [0])
+    self._document_offsets = array.array('q', [0])
+    self._arrays = None
+
+  def intern(self, string):
+    token_id = self.vocab_index.get(string)
+    if token_id is None:
+      token_id = len(self.vocab)
+      self.vocab_index[string] = token_id
+      self.vocab.append(string)
+    return token_id
+
+  def get_id(self, string):
+    """Returns the id of a string, or -1 if it never occurs."""
+    return self.vocab_index.get(string, -1)
+
+  def add_document(self, sentences, doc_id=None):
+    """Adds one document given as lists of token fields per sentence.
+
+    The #begin/#end pseudo-sentences of listified documents are skipped, and
+    the document id is read from #begin if not given.
+    """
+    for sentence in sentences:
+      first_fields = sentence[0]
+      if first_fields and first_fields[0].startswith("#"):
+        if first_fields[0] == "#begin" and doc_id is None:
+          doc_id = get_doc_id(first_fields)
+        continue
+      for fields in sentence:
+        for i in self.column_indices:
+          self._columns[i].append(
+              self.intern(fields[i] if i < len(fields) else ""))
+      self._sentence_offsets.append(len(self._columns[
+        self.column_indices[0]]))
+    self._document_offsets.append(len(self._sentence_offsets) - 1)
+    self.doc_ids.append(doc_id)
+    self._arrays = None
+
+  @classmethod
+  def from_documents(cls, documents, column_indices):
+    store = cls(column_indices)
+    for document in documents:
+      store.add_document(document)
+    return store
+
+  def _get_arrays(self):
+    if self._arrays is None:
+      self._arrays = (
+          {i: np.array(column, dtype=np.int32)
+            for i, column in self._columns.items()},
+          np.array(self._sentence_offsets, dtype=np.int64),
+          np.array(self._document_offsets, dtype=np.int64))
+    return self._arrays
+
+  def get_column(self, column_index):
+    return self._get_arrays()[0][column_index]
+
+  @property
+  def sentence_offsets(self):
+    return self._get_arrays()[1]
+
+  @property
+  def document_offsets(self):
+    return self._get_arrays()[2]
+
+  def __len__(self):
+    return len(self.doc_ids)
+
+  def get_num_sentences(self):
+    return len(self._sentence_offsets) - 1
+
+  def get_sentence_lengths(self):
+    return np.diff(self.sentence_offsets)
+
+  def get_sentence_tokens(self, sentence_index, column_index):
+    start, end = self.sentence_offsets[sentence_index:sentence_index + 2]
+    return [self.vocab[token_id]
+        for token_id in self.get_column(column_index)[start:end].tolist()]
 
+  def get_sentence_documents(self):
+    """The index of the document that each sentence belongs to."""
+    return np.repeat(np.arange(len(self.doc_ids)),
+        np.diff(self.document_offsets))
 
+  def find_sentences_ending_with(self, column_index, string):
+    """Indices of the non-empty sentences whose last token is string."""
+    lengths = self.get_sentence_lengths()
+    nonempty = np.flatnonzero(lengths > 0)
+    last_tokens = self.get_column(column_index)[
+        self.sentence_offsets[1:][nonempty] - 1]
+    return nonempty[last_tokens == self.get_id(string)]
@@ -1,21 +1,29 @@
+import bisect
 import collections
-import conll_lib
-import corenlp
-import json
+import concurrent.futures
+import contextlib
 import nltk
 import openreview
 import sys
+import time
 
 from tqdm import tqdm
 
+import annotation_lib
 import openreview_lib as orl
+import qa_data_lib
+import tokenize_lib
 
 SupNode = collections.namedtuple('SupNode', 'supnode_id tokens')
 Question = collections.namedtuple('Question', 'supnode_id start exclusive_end')
 Answer = collections.namedtuple('Answer', 'supnode_id question start exclusive_end')
 
+CHUNK_SEPARATOR = "\n\n"
+MAX_BATCH_CHARS = 50000
+FORUMS_PER_WORKER = 2  # Forums queued or in progress per worker process
+
 def chunk_text(text):
-  return text.split("\n\n")
+  return text.split(CHUNK_SEPARATOR)
 
 
 def longest_starting_prefix(chunk1, chunk2):
@@ -32,12 +40,12 @@ def prefixExistsAndNotAlpha(prefix):
 
 
 ANNOTATORS = "tokenize ssplit".split()
-IDX, TOKEN = range(2)
+# Blank lines between chunks must end sentences
+PROPERTIES = {"ssplit.newlineIsSentenceBreak": "two"}
 
 
-def get_mini_node_map(structure, node_map):
-  all_node_ids = set(structure.keys()).union(set(structure.values())) - set([None])
-  return {node_id:node_map[node_id] for node_id in all_node_ids}
+def get_mini_node_map(forum_tree, node_map):
+  return {node_id:node_map[node_id] for node_id in forum_tree.note_ids}
 
 
 def squish(chunk):
@@ -53,6 +61,9 @@ SEPARATOR_CHUNK = [[NEWLINE_TOK, NEWLINE_TOK]]
 
 
 class SuperNode(object):
+  __slots__ = ('original_id', 'node_id', 'title', 'text', 'author', 'children',
+      'included_nodes', 'question_map', 'tokenized_chunks', 'tokenized')
+
   def __init__(self, node_id, title, text, author):
     self.original_id = node_id
     self.node_id = superify(node_id)
@@ -82,22 +93,7 @@ class SuperNode(object):
     self.included_nodes.append(node.original_id)
 
   def tokenize(self, tokenize_client):
-    if self.tokenized:
-      return
-    chunks = chunk_text(self.text)
-    self.tokenized_chunks = []
-    for chunk in chunks:
-      tokenized = tokenize_client.annotate(chunk)
-      listified = conll_lib.listify_non_doc_lines(tokenized.split("\n"))
-      sentences = []
-      for sentence in listified:
-        sentence_tokens = [fields[TOKEN] for fields in sentence if fields]
-        sentences.append(sentence_tokens)
-      if sentences:
-        if self.tokenized_chunks:
-          self.tokenized_chunks.append(SEPARATOR_CHUNK)
-        self.tokenized_chunks.append(sentences)
-    self.tokenized = True
+    tokenize_nodes([self], tokenize_client)
   
   def get_questions(self):
     assert self.tokenized
@@ -117,6 +113,67 @@ class SuperNode(object):
   def __str__(self):
     return self.node_id
 
+def get_utf16_length(text):
+  # CoreNLP character offsets count UTF-16 code units
+  return len(text.encode("utf-16-le")) // 2
+
+
+def annotate_chunks(chunks, tokenize_client):
+  """Tokenizes chunks in one request and returns each chunk's sentences.
+
+  Chunks are joined by blank lines, which CoreNLP treats as sentence breaks,
+  and each sentence is assigned to a chunk by the offset of its first token.
+  """
+  chunk_starts = []
+  offset = 0
+  for chunk in chunks:
+    chunk_starts.append(offset)
+    offset += get_utf16_length(chunk) + len(CHUNK_SEPARATOR)
+
+  annotation = tokenize_client.annotate(CHUNK_SEPARATOR.join(chunks))
+  chunk_sentences = [[] for _ in chunks]
+  for sentence in annotation["sentences"]:
+    tokens = sentence["tokens"]
+    if not tokens:
+      continue
+    chunk_index = bisect.bisect_right(chunk_starts,
+        tokens[0]["characterOffsetBegin"]) - 1
+    chunk_sentences[chunk_index].append([token["word"] for token in tokens])
+  return chunk_sentences
+
+
+def tokenize_nodes(nodes, tokenize_client):
+  """Tokenizes the chunks of many supernodes with as few requests as possible."""
+  # Sorted so the batched text, and so its cache key, is the same every run
+  nodes = sorted((node for node in nodes if not node.tokenized),
+      key=lambda node: node.node_id)
+  node_chunks = [(node, chunk) for node in nodes
+      for chunk in chunk_text(node.text)]
+
+  all_sentences = []
+  batch = []
+  batch_chars = 0
+  for _, chunk in node_chunks:
+    if batch and batch_chars + len(chunk) > MAX_BATCH_CHARS:
+      all_sentences += annotate_chunks(batch, tokenize_client)
+      batch = []
+      batch_chars = 0
+    batch.append(chunk)
+    batch_chars += len(chunk) + len(CHUNK_SEPARATOR)
+  if batch:
+    all_sentences += annotate_chunks(batch, tokenize_client)
+
+  for node in nodes:
+    node.tokenized_chunks = []
+  for (node, _), sentences in zip(node_chunks, all_sentences):
+    if sentences:
+      if node.tokenized_chunks:
+        node.tokenized_chunks.append(SEPARATOR_CHUNK)
+      node.tokenized_chunks.append(sentences)
+  for node in nodes:
+    node.tokenized = True
+
+
 def superify(old_id):
   return old_id + "_super"
 
@@ -144,23 +201,16 @@ def restructure(forum_structure, node_map):
     else:
       parent_node.children.append(child)
 
-  new_supernode_structure = {}
   root, = [child
             for child, parent in supernode_structure.items()
             if parent is None]  # Should only be one such node
-  stack = [(root, None)]
-  while stack:  # Build new supernode structure
-    curr_node, parent = stack.pop(0)
-    new_children = supernode_map[curr_node].children
-    stack += [(child, curr_node) for child in new_children]
-    new_supernode_structure[curr_node] = parent
-
-  # Build map of supernodes that occur in the final structure
-  final_nodes = set(new_supernode_structure.keys()).union(
-      set(new_supernode_structure.values())) - set([None])
+  supernode_tree = orl.ForumTree.from_children(root,
+      {key: value.children for key, value in supernode_map.items()})
+  new_supernode_structure = supernode_tree.to_parent_map()
 
+  # Keep the supernodes that occur in the final structure
   supernode_map = {key: value for key, value in supernode_map.items() if key in
-      final_nodes}
+      supernode_tree}
 
   return new_supernode_structure, supernode_map
 
@@ -206,17 +256,20 @@ def find_chunk_pairs(child_node, parent_node):
   return questions, answers
 
 
-def get_questions_and_answers(forum_structure, node_map, tokenize_client):
-
-
+def get_final_nodes(forum_structure, node_map):
   final_nodes = set(
       forum_structure.keys()).union(
           set(forum_structure.values())) - set([None])
+  return [node_map[node_id] for node_id in sorted(final_nodes)]
+
+
+def get_questions_and_answers(forum_structure, node_map, tokenize_client):
+
+  nodes = get_final_nodes(forum_structure, node_map)
+  tokenize_nodes(nodes, tokenize_client)
 
   questions = []
-  for node_id in final_nodes:
-    node = node_map[node_id]
-    node.tokenize(tokenize_client)
+  for node in nodes:
     questions += node.get_questions()
 
   answers = []
@@ -231,39 +284,118 @@ def get_questions_and_answers(forum_structure, node_map, tokenize_client):
   return questions, answers
 
 
+def process_forum(structure, mini_node_map, tokenize_client):
+  """Supernodes, questions and answers of one forum, with seconds per stage."""
+  timings = collections.Counter()
+
+  start = time.perf_counter()
+  supernode_structure, supernode_map = restructure(structure, mini_node_map)
+  timings["restructure"] += time.perf_counter() - start
+
+  start = time.perf_counter()
+  tokenize_nodes(get_final_nodes(supernode_structure, supernode_map),
+      tokenize_client)
+  timings["tokenize"] += time.perf_counter() - start
+
+  start = time.perf_counter()
+  questions, answers = get_questions_and_answers(
+      supernode_structure, supernode_map, tokenize_client)
+  timings["questions_and_answers"] += time.perf_counter() - start
+
+  return list(supernode_map.values()), questions, answers, timings
+
+
+# Set in each worker process by init_worker
+WORKER_CLIENT = None
+
+
+def get_tokenize_kwargs(num_workers=1):
+  return {"annotators": ANNOTATORS, "properties": dict(PROPERTIES),
+      "output_format": 'json', "threads": max(5, num_workers)}
+
+
+def init_worker(backend):
+  """Workers share the CoreNLP server started by the main process."""
+  global WORKER_CLIENT
+  WORKER_CLIENT = tokenize_lib.make_tokenize_client(backend, start_server=False,
+      **get_tokenize_kwargs())
+  if backend == tokenize_lib.CORENLP:
+    WORKER_CLIENT = annotation_lib.get_cached_client(WORKER_CLIENT,
+        annotation_lib.get_cache())
+
+
+def process_forum_in_worker(forum_input):
+  return process_forum(*forum_input, WORKER_CLIENT)
+
+
+def iter_forum_results(pool, forum_inputs, max_in_flight):
+  """Yields process_forum results in forum order, keeping at most
+  max_in_flight forums submitted to the pool at a time."""
+  pending = collections.deque()
+  for forum_input in forum_inputs:
+    pending.append(pool.submit(process_forum_in_worker, forum_input))
+    if len(pending) >= max_in_flight:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+
+def iter_forum_inputs(dataset, timings):
+  for forum, structure in dataset.forum_map.items():
+    start = time.perf_counter()
+    mini_node_map = get_mini_node_map(dataset.forum_trees[forum],
+        dataset.node_map)
+    timings["mini_node_map"] += time.perf_counter() - start
+    yield structure, mini_node_map
+
+
 def main():
 
-  dataset_file, output_prefix = sys.argv[1:]
+  dataset_file, output_prefix = sys.argv[1:3]
+  backend = sys.argv[3] if len(sys.argv) > 3 else tokenize_lib.CORENLP
+  num_workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+  compress = len(sys.argv) > 5 and sys.argv[5] == "gzip"
+
+  with contextlib.ExitStack() as stack:
+    tokenize_client = stack.enter_context(tokenize_lib.get_tokenize_client(
+      backend, **get_tokenize_kwargs(num_workers)))
+    if backend == tokenize_lib.CORENLP:
+      tokenize_client = annotation_lib.get_cached_client(tokenize_client,
+          annotation_lib.get_cache())
+    pool = None
+    if num_workers > 1:
+      pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+        num_workers, initializer=init_worker, initargs=(backend,)))
 
-  with corenlp.CoreNLPClient(annotators=ANNOTATORS, output_format='conll') as corenlp_client:
     for split, dataset in orl.get_datasets(dataset_file, debug=False).items():
 
-      all_nodes = []
-      all_questions = []
-      all_answers = []
-
-      for forum, structure in tqdm(dataset.forum_map.items()):
-        mini_node_map = get_mini_node_map(structure, dataset.node_map)
-        supernode_structure, supernode_map = restructure(structure,
-            mini_node_map)
-        questions, answers = get_questions_and_answers(
-            supernode_structure, supernode_map, corenlp_client)
-        all_nodes += supernode_map.values()
-        all_questions += questions
-        all_answers += answers
-    
-      output_obj = {
-      "conference": dataset.conference,
-      "split": split,
-      "nodes": [node.serialize() for node in all_nodes],
-      "questions": [q._asdict() for q in all_questions],
-      "answers": [a._asdict() for a in all_answers]
-      }
-
-      output_filename = "_".join(
-          [output_prefix + "qaPairs", dataset.conference, dataset.split + ".json"])
-      with open(output_filename, 'w') as f:
-        f.write(json.dumps(output_obj))
+      output_filename = qa_data_lib.get_qa_filename(output_prefix,
+          dataset.conference, dataset.split, compress)
+      timings = collections.Counter()
+      split_start = time.perf_counter()
+
+      forum_inputs = iter_forum_inputs(dataset, timings)
+      if pool is None:
+        results = (process_forum(structure, mini_node_map, tokenize_client)
+            for structure, mini_node_map in forum_inputs)
+      else:
+        results = iter_forum_results(pool, forum_inputs,
+            FORUMS_PER_WORKER * num_workers)
+
+      with qa_data_lib.QaPairsWriter(output_filename, dataset.conference,
+          split) as writer:
+        for forum, (nodes, questions, answers, forum_timings) in zip(
+            dataset.forum_map, tqdm(results, total=len(dataset.forum_map))):
+          writer.write_forum(forum,
+              [node.serialize() for node in nodes],
+              [q._asdict() for q in questions],
+              [a._asdict() for a in answers])
+          timings.update(forum_timings)
+
+      print("Processed {0} forums of {1} in {2:.1f}s".format(
+        len(dataset.forum_map), split, time.perf_counter() - split_start))
+      for stage, seconds in timings.items():
+        print("  {0}: {1:.1f}s".format(stage, seconds))
 
 
 if __name__ == "__main__":
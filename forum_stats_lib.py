@@ -0,0 +1,144 @@
+import numpy as np
+import sys
+
+import openreview_lib as orl
+
+ROLES = "RAXCSN"
+
+
+def get_role(author):
+  if author.startswith("AnonReviewer"):
+    return "R"
+  if author.startswith("Author"):
+    return "A"
+  if author.startswith("Conference"):
+    return "X"
+  if author.startswith("Area_Chair"):
+    return "C"
+  if author.startswith("(anonymous)"):
+    return "S" # Spectator
+  else:
+    return "N" # Actual name
+
+
+class ForumStats(object):
+  """Statistics for many forums, computed at once over flat tree arrays.
+
+  All forums' ForumTrees are concatenated, with parent indices shifted to
+  global positions, and every statistic is a NumPy reduction keyed by the
+  forum index of each note. Thread statistics are over the subtrees rooted
+  at direct replies to the submission.
+  """
+
+  def __init__(self, forum_trees, node_map):
+    forum_trees = {forum_id: tree for forum_id, tree in forum_trees.items()
+        if len(tree)}
+    self.forum_ids = list(forum_trees)
+    trees = list(forum_trees.values())
+    num_forums = len(trees)
+    if not num_forums:
+      self._set_empty()
+      return
+
+    self.num_notes = np.array([len(tree) for tree in trees], dtype=np.int64)
+    starts = np.zeros(num_forums, dtype=np.int64)
+    starts[1:] = np.cumsum(self.num_notes)[:-1]
+    forums = np.repeat(np.arange(num_forums), self.num_notes)
+
+    local_parents = np.concatenate([tree.parents for tree in trees])
+    parents = np.where(local_parents < 0, -1, local_parents + starts[forums])
+    depths = np.concatenate([tree.depths for tree in trees])
+    child_counts = np.concatenate(
+        [np.diff(tree.child_offsets) for tree in trees])
+
+    # Depth
+    self.max_depth = np.maximum.reduceat(depths, starts)
+    self.mean_depth = np.bincount(forums, weights=depths,
+        minlength=num_forums) / self.num_notes
+    self.depth_counts = np.zeros((num_forums, self.max_depth.max() + 1),
+        dtype=np.int64)
+    np.add.at(self.depth_counts, (forums, depths), 1)
+
+    # Branching factor: mean number of replies to notes that have any
+    internal = child_counts > 0
+    num_internal = np.bincount(forums[internal], minlength=num_forums)
+    self.branching_factor = np.divide(self.num_notes - 1, num_internal,
+        out=np.zeros(num_forums), where=num_internal > 0)
+
+    # Participants
+    authors = [node_map[note_id].author
+        for tree in trees for note_id in tree.note_ids]
+    author_vocab, author_ids = np.unique(authors, return_inverse=True)
+    role_ids = np.array([ROLES.index(get_role(author))
+      for author in author_vocab])[author_ids]
+    self.role_counts = np.zeros((num_forums, len(ROLES)), dtype=np.int64)
+    np.add.at(self.role_counts, (forums, role_ids), 1)
+    forum_authors = np.unique(forums * len(author_vocab) + author_ids)
+    self.num_participants = np.bincount(forum_authors // len(author_vocab),
+        minlength=num_forums)
+
+    # Threads: every note below the root inherits the thread of its parent,
+    # one depth level at a time
+    threads = np.where(depths == 1, np.arange(len(depths)), -1)
+    for depth in range(2, self.depth_counts.shape[1]):
+      at_depth = depths == depth
+      threads[at_depth] = threads[parents[at_depth]]
+    in_thread = threads >= 0
+    thread_sizes = np.bincount(threads[in_thread], minlength=len(depths))
+    self.thread_heads = np.flatnonzero(depths == 1)
+    self.thread_lengths = thread_sizes[self.thread_heads]
+    self.thread_forums = forums[self.thread_heads]
+    num_threads = np.bincount(self.thread_forums, minlength=num_forums)
+    self.num_threads = num_threads
+    self.mean_thread_length = np.divide(
+        np.bincount(self.thread_forums, weights=self.thread_lengths,
+          minlength=num_forums), num_threads,
+        out=np.zeros(num_forums), where=num_threads > 0)
+    self.max_thread_length = np.zeros(num_forums, dtype=np.int64)
+    np.maximum.at(self.max_thread_length, self.thread_forums,
+        self.thread_lengths)
+
+  def _set_empty(self):
+    """Per-forum arrays for a split with no forums, e.g. when all failed."""
+    self.num_notes = np.zeros(0, dtype=np.int64)
+    self.max_depth = np.zeros(0, dtype=np.int64)
+    self.mean_depth = np.zeros(0)
+    self.depth_counts = np.zeros((0, 0), dtype=np.int64)
+    self.branching_factor = np.zeros(0)
+    self.role_counts = np.zeros((0, len(ROLES)), dtype=np.int64)
+    self.num_participants = np.zeros(0, dtype=np.int64)
+    self.thread_heads = np.zeros(0, dtype=np.int64)
+    self.thread_lengths = np.zeros(0, dtype=np.int64)
+    self.thread_forums = np.zeros(0, dtype=np.int64)
+    self.num_threads = np.zeros(0, dtype=np.int64)
+    self.mean_thread_length = np.zeros(0)
+    self.max_thread_length = np.zeros(0, dtype=np.int64)
+
+  def get_rows(self):
+    """One tuple of summary statistics per forum."""
+    for i, forum_id in enumerate(self.forum_ids):
+      yield ((forum_id, int(self.num_notes[i]), int(self.num_participants[i]),
+        float(self.mean_depth[i]), int(self.max_depth[i]),
+        float(self.branching_factor[i]), int(self.num_threads[i]),
+        float(self.mean_thread_length[i]), int(self.max_thread_length[i]))
+        + tuple(int(count) for count in self.role_counts[i]))
+
+
+HEADER = ("forum", "notes", "participants", "mean_depth", "max_depth",
+    "branching_factor", "threads", "mean_thread_length", "max_thread_length"
+    ) + tuple("role_" + role for role in ROLES)
+
+
+def main():
+  dataset_file = sys.argv[1]
+
+  for split, dataset in orl.get_datasets(dataset_file).items():
+    stats = ForumStats(dataset.forum_trees, dataset.node_map)
+    with open(split + "_forum_stats.tsv", 'w') as f:
+      f.write("\t".join(HEADER) + "\n")
+      for row in stats.get_rows():
+        f.write("\t".join(str(value) for value in row) + "\n")
+
+
+if __name__ == "__main__":
+  main()
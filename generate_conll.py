@@ -1,31 +1,40 @@
+import contextlib
 import corenlp
 import json
 import openreview
 import sys
 
+import annotation_lib
 import openreview_lib as orl
 
 
 ANNOTATORS = "tokenize ssplit pos lemma".split()
+ENDPOINT_TEMPLATE = "http://localhost:{0}"
+BASE_PORT = 9000
 
 
 def main():
   dataset_file = sys.argv[1]
-
-  with corenlp.CoreNLPClient(
-      annotators=ANNOTATORS, timeout=200000,
-      output_format="conll") as conll_client:
-
-    with corenlp.CoreNLPClient(
-        annotators=ANNOTATORS, timeout=200000,
-        output_format="json") as json_client:
-
-      conference = "iclr19"
-      datasets = orl.get_datasets(dataset_file)
-      for set_split, dataset in datasets.items():
-        filepath = "tokenized/" + conference + "/" + set_split + "/"
-        dataset.dump_to_conll(filepath, conll_client, json_client,
-            no_parse=True)
+  num_servers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+  with contextlib.ExitStack() as stack:
+    conll_clients = [stack.enter_context(corenlp.CoreNLPClient(
+      annotators=ANNOTATORS, timeout=200000, output_format="conll",
+      endpoint=ENDPOINT_TEMPLATE.format(BASE_PORT + i)))
+      for i in range(num_servers)]
+
+    json_client = stack.enter_context(corenlp.CoreNLPClient(
+        annotators=ANNOTATORS, timeout=200000, output_format="json",
+        endpoint=ENDPOINT_TEMPLATE.format(BASE_PORT + num_servers)))
+
+    annotation_engine = annotation_lib.AnnotationEngine(conll_clients,
+        cache=annotation_lib.get_cache())
+
+    datasets = orl.get_datasets(dataset_file)
+    for set_split, dataset in datasets.items():
+      filepath = "tokenized/" + dataset.conference + "/" + set_split + "/"
+      dataset.dump_to_conll(filepath, annotation_engine, json_client,
+          no_parse=True, incremental=True)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,17 @@
 import collections
 import json
+import numpy as np
 import openreview
+import os
 import sys
 import random
 
 from tqdm import tqdm
 
 import openreview_lib as orl
+import snapshot_lib
+
+NOTE_COUNTS_SUFFIX = "_note_counts.json"
 
 def get_forum_ids(guest_client, invitation):
   submissions = openreview.tools.iterget_notes(
@@ -15,8 +20,9 @@ def get_forum_ids(guest_client, invitation):
 
 TRAIN, DEV, TEST = ("train", "dev", "test")
 
-def split_forums(forums):
-  random.shuffle(forums)
+def split_forums(forums, rng):
+  forums = sorted(forums)
+  rng.shuffle(forums)
   train_threshold = int(0.6 * len(forums))
   dev_threshold = int(0.8 * len(forums))
 
@@ -29,59 +35,77 @@ class Forum(object):
     notes = client.get_notes(forum=forum_id)
     self.num_notes = len(notes)
 
-def main():
-
-  conference = sys.argv[1]
-
+def fetch_note_counts(conference):
   guest_client = openreview.Client(baseurl='https://openreview.net')
 
   forum_ids = get_forum_ids(guest_client, orl.INVITATION_MAP[conference])
 
-  len_counter = collections.Counter()
-
-  forums = []
+  note_counts = {}
   for forum_id in tqdm(forum_ids):
-    new_forum = Forum(forum_id, guest_client)
-    len_counter[new_forum.num_notes] += 1
-    forums.append(new_forum)
-
-  total_notes = sum(len_counter.values())
-  bottom_quintile_count = int(0.2 * total_notes)
-  top_quintile_count = int(0.8 * total_notes)
-
-  bottom_quintile_num_posts = None
-  top_quintile_num_posts = None
-
-  num_notes_seen = 0
-  for num_posts in sorted(len_counter.keys()):
-    num_notes = len_counter[num_posts]
-    num_notes_seen += num_notes
-    if bottom_quintile_num_posts is None:
-      if num_notes_seen > bottom_quintile_count:
-        bottom_quintile_num_posts = num_posts
-    elif top_quintile_num_posts is None:
-      if num_notes_seen > top_quintile_count:
-        top_quintile_num_posts = num_posts
-        break
-
-  small_forums = [forum for forum in forums if forum.num_notes <=
-    bottom_quintile_num_posts]
-
-  large_forums = [forum for forum in forums if forum.num_notes >=
-    top_quintile_num_posts]
-
-  medium_forums = [forum 
-    for forum in forums
-    if forum not in small_forums and forum not in large_forums]
+    note_counts[forum_id] = Forum(forum_id, guest_client).num_notes
+  return note_counts
+
+def get_note_counts(conference):
+  """Reads per-forum note counts from a cache file, a snapshot, or the API."""
+  counts_file = conference + NOTE_COUNTS_SUFFIX
+  if os.path.exists(counts_file):
+    with open(counts_file, 'r') as f:
+      return json.loads(f.read())
+
+  note_counts = None
+  snapshot_dir = os.environ.get(orl.SNAPSHOT_DIR_VAR)
+  if snapshot_dir is not None:
+    note_counts = snapshot_lib.get_note_counts(snapshot_dir, conference)
+  if not note_counts:
+    note_counts = fetch_note_counts(conference)
+
+  with open(counts_file, 'w') as f:
+    f.write(json.dumps(note_counts))
+  return note_counts
+
+def get_quintile_thresholds(num_notes):
+  """Number of notes at or below which a forum is small, and at or above
+  which it is large."""
+  sorted_num_notes = np.sort(num_notes)
+  bottom_quintile_num_posts = sorted_num_notes[int(0.2 * len(num_notes))]
+
+  # The large threshold must be strictly above the small one
+  next_index = np.searchsorted(sorted_num_notes, bottom_quintile_num_posts,
+      side='right')
+  if next_index == len(sorted_num_notes):
+    return bottom_quintile_num_posts, np.inf
+  top_quintile_num_posts = max(
+      sorted_num_notes[int(0.8 * len(num_notes))],
+      sorted_num_notes[next_index])
+  return bottom_quintile_num_posts, top_quintile_num_posts
+
+def stratified_split(note_counts, rng):
+  forum_ids = np.array(sorted(note_counts))
+  num_notes = np.array([note_counts[forum_id] for forum_id in forum_ids])
+
+  bottom_quintile_num_posts, top_quintile_num_posts = get_quintile_thresholds(
+      num_notes)
+  is_small = num_notes <= bottom_quintile_num_posts
+  is_large = num_notes >= top_quintile_num_posts
+  is_medium = ~(is_small | is_large)
 
   forum_name_map = collections.defaultdict(list)
 
-  for forum_set in [medium_forums, small_forums, large_forums]:
-    train, dev, test = split_forums(forum_set)
-    forum_name_map[TRAIN] += [forum.forum_id for forum in train]
-    forum_name_map[DEV] += [forum.forum_id for forum in dev]
-    forum_name_map[TEST] += [forum.forum_id for forum in test]
+  for forum_mask in [is_medium, is_small, is_large]:
+    train, dev, test = split_forums(forum_ids[forum_mask].tolist(), rng)
+    forum_name_map[TRAIN] += train
+    forum_name_map[DEV] += dev
+    forum_name_map[TEST] += test
+
+  return forum_name_map
+
+def main():
+
+  conference = sys.argv[1]
+  seed = int(sys.argv[2]) if len(sys.argv) > 2 else None
 
+  note_counts = get_note_counts(conference)
+  forum_name_map = stratified_split(note_counts, random.Random(seed))
 
   dataset = {
     "conference": conference,
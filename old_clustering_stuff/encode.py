@@ -12,35 +12,37 @@ FORUM_ID, NOTE_ID, IDK_2, IDK_3, TOKEN, MOD_TOKEN, LEMMA, POS = range(8)
 def make_para_id(fields):
   return fields[FORUM_ID] + "_" + fields[NOTE_ID]
 
+def iter_conll_sentences(lines):
+  """Yields the fields of each blank-line terminated sentence."""
+  current_sentence = []
+  for line in lines:
+    if not line.strip():
+      if current_sentence:
+        yield current_sentence
+      current_sentence = []
+    else:
+      current_sentence.append(line.strip().split("\t"))
+
+def iter_conll_paragraphs(lines):
+  """Yields (paragraph id, sentences) for consecutive sentences of a paragraph."""
+  current_para_id = None
+  current_para = []
+
+  for sentence in iter_conll_sentences(lines):
+    this_sentence_para_id = make_para_id(sentence[0])
+    if not this_sentence_para_id == current_para_id:
+      if current_para_id is not None:
+        yield current_para_id, current_para
+      current_para = []
+      current_para_id = this_sentence_para_id
+    current_para.append(sentence)
+
+  if current_para_id is not None:
+    yield current_para_id, current_para
+
 def read_conll_file(filename):
   with open(filename, 'r') as f:
-    conll_lines = f.readlines()
-
-    paragraphs = {}
-    
-    current_para_id = None
-    current_sentence = []
-    current_para = []
-
-    for line in conll_lines:
-
-      if not line.strip():
-        if current_sentence:
-          current_para.append(current_sentence)
-        current_sentence = []
-
-      else:
-        fields = line.strip().split("\t")
-        this_line_para_id = make_para_id(fields)
-        if not this_line_para_id == current_para_id:
-          assert not current_sentence
-          if current_para_id is not None:
-            paragraphs[current_para_id] = current_para
-          current_para = []
-          current_para_id = this_line_para_id
-        current_sentence.append(fields)
-
-  return paragraphs
+    return dict(iter_conll_paragraphs(f))
 
 def get_sentence_tokens(field_list):
   return [fields[MOD_TOKEN] for fields in field_list]
@@ -1,22 +1,74 @@
 import time
 import collections
+import concurrent.futures
 import json
+import numpy as np
 import openreview
+import os
 
 from tqdm import tqdm
 
+import conll_lib
+import snapshot_lib
 
-def get_datasets(dataset_file, debug=False):
+SNAPSHOT_DIR_VAR = "REVIEW_SNAPSHOT_DIR"
+OFFLINE_VAR = "REVIEW_OFFLINE"
+MAX_WORKERS_VAR = "REVIEW_MAX_WORKERS"
+MAX_AGE_VAR = "REVIEW_SNAPSHOT_MAX_AGE"
+
+MANIFEST_SAVE_INTERVAL = 500
+
+
+def get_datasets(dataset_file, debug=False, snapshot_dir=None, offline=None,
+    max_age=None, max_workers=None):
+  """Builds a Dataset per split of the dataset file.
+
+  If a snapshot directory is given (or set in $REVIEW_SNAPSHOT_DIR), forums
+  are read from the local snapshot first and only missing or stale forums are
+  requested from OpenReview. In offline mode ($REVIEW_OFFLINE) the snapshot is
+  the only source of notes. Forums are fetched by up to max_workers threads
+  ($REVIEW_MAX_WORKERS).
+
+  A snapshot forum is refetched when its submission has been modified since
+  it was captured. New replies do not modify the submission, so to pick them
+  up set max_age ($REVIEW_SNAPSHOT_MAX_AGE), in seconds, after which forums
+  are refetched regardless.
+  """
   with open(dataset_file, 'r') as f:
     examples = json.loads(f.read())
 
-  guest_client = openreview.Client(baseurl='https://api.openreview.net')
+  if snapshot_dir is None:
+    snapshot_dir = os.environ.get(SNAPSHOT_DIR_VAR)
+  if offline is None:
+    offline = bool(os.environ.get(OFFLINE_VAR))
+  if max_workers is None:
+    max_workers = int(os.environ.get(MAX_WORKERS_VAR, 1))
+  if max_age is None and os.environ.get(MAX_AGE_VAR):
+    max_age = float(os.environ[MAX_AGE_VAR])
+
   conference = examples["conference"]
   assert conference in Conference.ALL 
 
+  snapshots = {}
+  if snapshot_dir is not None:
+    for set_split, forum_ids in examples["id_map"].items():
+      snapshots[set_split] = snapshot_lib.ForumSnapshot(
+          snapshot_lib.get_snapshot_path(
+            snapshot_dir, conference, set_split, forum_ids))
+
+  if offline:
+    assert snapshots, "Offline mode requires a snapshot directory"
+    guest_client = snapshot_lib.SnapshotClient(snapshots.values())
+  else:
+    guest_client = openreview.Client(baseurl='https://api.openreview.net')
+
+  submissions = get_submissions(guest_client, conference)
+
   datasets = {}
   for set_split, forum_ids in examples["id_map"].items():
-    dataset = Dataset(forum_ids, guest_client, conference, set_split, debug)
+    dataset = Dataset(forum_ids, guest_client, conference, set_split, debug,
+        submissions=submissions, snapshot=snapshots.get(set_split),
+        max_age=max_age, max_workers=max_workers)
     datasets[set_split] = dataset
 
   return datasets
@@ -34,6 +86,154 @@ INVITATION_MAP = {
 }
 
 
+def get_submissions(client, conference):
+  """Lists a conference's submissions once, keyed by forum id."""
+  submissions = openreview.tools.iterget_notes(
+        client, invitation=INVITATION_MAP[conference])
+  return {n.forum: n for n in submissions}
+
+
+def get_note_index(forum_map):
+  """Maps each note id in a forum map to its (parent, forum root) pair."""
+  note_index = {}
+  for forum_id, parent_map in forum_map.items():
+    for note_id, parent in parent_map.items():
+      note_index[note_id] = (parent, forum_id)
+  return note_index
+
+
+def get_non_orphans(parents, root):
+  """Keeps the notes that can be reached from the forum root.
+
+  Notes other than root whose parent is None are extra roots; they are
+  pruned along with their replies. Returns the pruned {child: parent} map,
+  the matching {parent: [children]} index and the list of extra roots.
+  """
+  children = collections.defaultdict(list)
+  for child, parent in parents.items():
+    children[parent].append(child)
+  roots = [root] if parents.get(root, root) is None else []
+  extra_roots = [child for child in children.get(None, []) if child != root]
+
+  reachable = set()
+  stack = list(roots)
+  while stack:
+    node = stack.pop()
+    reachable.add(node)
+    stack.extend(children.get(node, []))
+
+  new_children = {parent: roots if parent is None else child_list
+      for parent, child_list in children.items()
+      if parent is None or parent in reachable}
+  new_parents = {child: parent
+      for parent, child_list in new_children.items()
+      for child in child_list}
+
+  return new_parents, new_children, extra_roots
+
+
+class ForumTree(object):
+  """A forum's reply tree stored in flat arrays.
+
+  Notes are kept in breadth-first order from the root, with children in the
+  order of the children index they were built from, so the children of note
+  i are the contiguous indices child_offsets[i]:child_offsets[i + 1].
+  parents[i] is the index of note i's parent (-1 for the root) and depths[i]
+  its distance from the root.
+  """
+
+  def __init__(self, note_ids, parents, child_offsets, depths):
+    self.note_ids = note_ids
+    self.parents = parents
+    self.child_offsets = child_offsets
+    self.depths = depths
+    self.index = {note_id: i for i, note_id in enumerate(note_ids)}
+
+  @classmethod
+  def from_children(cls, root, children):
+    """Builds the tree below root from a {parent: [children]} index."""
+    note_ids = [root]
+    parent_list = [-1]
+    depth_list = [0]
+    child_counts = []
+    i = 0
+    while i < len(note_ids):
+      child_list = children.get(note_ids[i], [])
+      child_counts.append(len(child_list))
+      note_ids.extend(child_list)
+      parent_list.extend([i] * len(child_list))
+      depth_list.extend([depth_list[i] + 1] * len(child_list))
+      i += 1
+
+    child_offsets = np.ones(len(note_ids) + 1, dtype=np.int64)
+    child_offsets[1:] += np.cumsum(child_counts)
+    return cls(note_ids, np.array(parent_list, dtype=np.int64),
+        child_offsets, np.array(depth_list, dtype=np.int64))
+
+  @classmethod
+  def from_parent_map(cls, parents, children=None):
+    """Builds the tree from a {child: parent} map whose root maps to None."""
+    if children is None:
+      children = collections.defaultdict(list)
+      for child, parent in parents.items():
+        children[parent].append(child)
+    roots = children.get(None, [])
+    if not roots:
+      return cls([], np.zeros(0, dtype=np.int64),
+          np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if len(roots) > 1:
+      raise ValueError("Several roots: {0}".format(" ".join(roots)))
+    return cls.from_children(roots[0], children)
+
+  def __len__(self):
+    return len(self.note_ids)
+
+  def __contains__(self, note_id):
+    return note_id in self.index
+
+  @property
+  def root(self):
+    return self.note_ids[0] if self.note_ids else None
+
+  def get_parent(self, note_id):
+    parent_index = self.parents[self.index[note_id]]
+    return None if parent_index < 0 else self.note_ids[parent_index]
+
+  def get_children(self, note_id):
+    i = self.index[note_id]
+    return self.note_ids[self.child_offsets[i]:self.child_offsets[i + 1]]
+
+  def get_depth(self, note_id):
+    return int(self.depths[self.index[note_id]])
+
+  def iter_edges(self):
+    """Yields (child, parent) for every non-root note, in tree order."""
+    for i, parent_index in enumerate(self.parents.tolist()):
+      if parent_index >= 0:
+        yield self.note_ids[i], self.note_ids[parent_index]
+
+  def get_ancestors(self, note_id):
+    """The ancestors of a note, from its parent up to the root."""
+    ancestors = []
+    i = self.parents[self.index[note_id]]
+    while i >= 0:
+      ancestors.append(self.note_ids[i])
+      i = self.parents[i]
+    return ancestors
+
+  def get_subtree(self, note_id):
+    """The note and all of its descendants, in breadth-first order."""
+    indices = [self.index[note_id]]
+    for i in indices:
+      indices.extend(range(self.child_offsets[i], self.child_offsets[i + 1]))
+    return [self.note_ids[i] for i in indices]
+
+  def to_parent_map(self):
+    """The {child: parent} map of the tree, in breadth-first order."""
+    return {note_id: (None if parent_index < 0 else self.note_ids[parent_index])
+        for note_id, parent_index in zip(self.note_ids, self.parents.tolist())}
+
+
 def get_author(signatures):
  return "_".join(sorted(sig.split("/")[-1] for sig in signatures))
 
@@ -103,97 +303,178 @@ def build_conll_lines(conll_text, parse_list, note_id, parent, root,
   return new_lines
 
 class NoteNode(object):
+  __slots__ = ('note_id', 'tcdate', 'tmdate', 'title', 'text', 'author',
+      'reply_to_id', '_replies')
 
   def __init__(self, note, reply_to=None):
     self.note_id = note.id
     self.tcdate = note.tcdate
+    self.tmdate = note.tmdate
     self.title = note.content["title"]
     self.text = get_text_if_any(note)
     self.author = get_author(note.signatures)
-    self.creation_time = get_strdate(note)
-    self.replies = []
     self.reply_to_id = note.replyto
+    self._replies = None
+
+  @property
+  def creation_time(self):
+    return get_strdate(self)
+
+  @property
+  def replies(self):
+    if self._replies is None:
+      self._replies = []
+    return self._replies
 
   def __str__(self):
     return str(self.author) + str(self.reply_to_id) +  str(self.text)
 
 
 class Dataset(object):
-  def __init__(self, forum_list, client, conference, split, debug=False):
-    
-    submissions = openreview.tools.iterget_notes(
-          client, invitation=INVITATION_MAP[conference])
-    self.forums = [n.forum for n in submissions if n.forum in forum_list]
+  def __init__(self, forum_list, client, conference, split, debug=False,
+      submissions=None, snapshot=None, max_age=None, max_workers=1,
+      max_retries=3, backoff=1.0):
+
+    if submissions is None:
+      submissions = get_submissions(client, conference)
+    forum_set = set(forum_list)
+    self.forums = [forum_id for forum_id in submissions
+        if forum_id in forum_set]
+    self.submission_tmdates = {forum_id: submissions[forum_id].tmdate
+        for forum_id in self.forums}
     if debug:
       self.forums = self.forums[:5]
     self.client = client
     self.conference = conference
     self.split = split
-    self.forum_map, self.node_map = self._get_forum_map()
+    self.snapshot = snapshot
+    self.max_age = max_age
+    self.max_workers = max_workers
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.failed_forums = {forum_id: "Not among the conference submissions"
+        for forum_id in forum_list if forum_id not in submissions}
+    self.extra_roots = {}
+    (self.forum_map, self.node_map, self.note_index,
+        self.forum_trees) = self._get_forum_map()
+    if self.snapshot is not None:
+      self.snapshot.save()
 
   def _get_forum_map(self):
-    """Builds a forum map, which maps forum ids to a dict tree of note ids."""
+    """Builds a forum map, which maps forum ids to a dict tree of note ids.
+
+    Also builds the note index, which maps each note id to its parent and
+    forum root, and a ForumTree for each forum.
+
+    With max_workers > 1, forums are fetched concurrently; results are still
+    merged in the order of self.forums. Forums that fail after all retries are
+    left out and recorded in self.failed_forums.
+    """
+    if self.max_workers > 1:
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=self.max_workers) as executor:
+        results = list(tqdm(executor.map(self._get_forum_structure,
+          self.forums), total=len(self.forums)))
+    else:
+      results = [self._get_forum_structure(forum_id)
+          for forum_id in tqdm(self.forums)]
+
     root_map = {}
     node_map = {}
-    for forum_id in tqdm(self.forums):
-      forum_structure, forum_node_map = self._get_forum_structure(forum_id)
+    forum_trees = {}
+    for forum_id, result in zip(self.forums, results):
+      if result is None:
+        continue
+      forum_structure, forum_node_map, forum_tree = result
       root_map[forum_id] = forum_structure
       node_map.update(forum_node_map)
-
-    return root_map, node_map
-
-  def _get_forum_non_orphans(self, parents):
-
-    children = collections.defaultdict(list)
-    for child, parent in parents.items():
-      children[parent].append(child)
-
-    descendants = sum(children.values(), [])
-    ancestors = children.keys()
-    nonchildren = set(ancestors) - set(descendants)
-    orphans = sorted(list(nonchildren - set([None])))
-
-    while orphans:
-      current_orphan = orphans.pop()
-      orphans += children[current_orphan]
-      del children[current_orphan]
-
-    new_parents = {}
-    for parent, child_list in children.items():
-      for child in child_list:
-        assert child not in new_parents
-        new_parents[child] = parent
-
-    return new_parents 
+      forum_trees[forum_id] = forum_tree
+
+    if self.failed_forums:
+      print("Failed to load {0} forums: {1}".format(
+        len(self.failed_forums), " ".join(sorted(self.failed_forums))))
+    if self.extra_roots:
+      print("Pruned notes with no parent other than the submission from {0} "
+          "forums: {1}".format(len(self.extra_roots),
+            " ".join(sorted(self.extra_roots))))
+
+    return root_map, node_map, get_note_index(root_map), forum_trees
+
+  def _get_notes(self, forum_id):
+    """Reads a forum from the snapshot, fetching it if missing or stale.
+
+    Returns None, and records the error in self.failed_forums, if the forum
+    could not be fetched.
+    """
+    if self.snapshot is not None and not self.snapshot.is_stale(forum_id,
+        self.submission_tmdates.get(forum_id), self.max_age):
+      return self.snapshot.get_notes(forum_id)
+    try:
+      notes = self._fetch_notes(forum_id)
+    except Exception as e:
+      self.failed_forums[forum_id] = repr(e)
+      return None
+    if self.snapshot is not None:
+      self.snapshot.add_forum(forum_id, notes)
+    return notes
+
+  def _fetch_notes(self, forum_id):
+    """Requests a forum from the client, retrying with exponential backoff."""
+    for attempt in range(self.max_retries + 1):
+      try:
+        return self.client.get_notes(forum=forum_id)
+      except Exception:
+        if attempt == self.max_retries:
+          raise
+        time.sleep(self.backoff * 2 ** attempt)
 
   def _get_forum_structure(self, forum_id):
     """Builds the reply structure for one forum."""
 
-    notes = self.client.get_notes(forum=forum_id)
+    notes = self._get_notes(forum_id)
+    if notes is None:
+      return None
     node_map = {note.id:NoteNode(note) for note in notes}
     naive_parents = {note.id:note.replyto for note in notes}
 
-    parents = self._get_forum_non_orphans(naive_parents)
-    available_notes = set(parents.keys()).union(
-        set(parents.values())) - set([None])
-
-    new_node_map = {note.id: node_map[note.id] for note in notes if note.id in available_notes}
-    return parents, new_node_map
-
-  def _get_parent_and_root(self, node):
-    for forum, parent_map in self.forum_map.items():
-      if node not in parent_map:
-        continue
-      else:
-        return parent_map[node], forum
-    assert False
-
-
-  def dump_to_conll(self, filename, conll_client, json_client, no_parse=False):
-    lines = []
-    for note_id, node in tqdm(self.node_map.items()):
-      with open(filename + note_id + ".txt", 'w') as f:
-        parent, root = self._get_parent_and_root(note_id)
+    parents, children, extra_roots = get_non_orphans(naive_parents, forum_id)
+    if extra_roots:
+      self.extra_roots[forum_id] = extra_roots
+    forum_tree = ForumTree.from_parent_map(parents, children)
+
+    new_node_map = {note.id: node_map[note.id] for note in notes if note.id in forum_tree}
+    return parents, new_node_map, forum_tree
+
+  def get_parent_and_root(self, note_id):
+    """Returns the parent and forum root of a note."""
+    return self.note_index[note_id]
+
+
+  def dump_to_conll(self, filename, annotation_engine, json_client,
+      no_parse=False, incremental=False):
+    """Annotates every note and writes the documents to sharded CoNLL files.
+
+    The shard manifest records the location and text hash of each note's
+    document. In incremental mode, notes whose text, parent and root are
+    unchanged since the last run are skipped and new documents are appended;
+    anything written after the last manifest save is discarded first, so an
+    interrupted run resumes from the last recorded note.
+    """
+    text_hashes = {}
+    for note_id, node in self.node_map.items():
+      parent, root = self.get_parent_and_root(note_id)
+      text_hashes[note_id] = conll_lib.get_text_hash(
+          node.text, str(parent), root, str(no_parse))
+
+    with conll_lib.ShardedConllWriter(filename, incremental) as writer:
+      writer.retain(self.node_map)
+      items = [(note_id, node.text)
+          for note_id, node in self.node_map.items()
+          if not writer.is_current(note_id, text_hashes[note_id])]
+
+      for i, (note_id, conll_text) in enumerate(tqdm(
+          annotation_engine.annotate_all(items), total=len(items))):
+        parent, root = self.get_parent_and_root(note_id)
         #parses = [obj["parse"] for obj in
         #    json_client.annotate(node.text)["sentences"]]
         #new_parses = [get_constparse_column(parse) for parse in parses] 
@@ -203,7 +484,8 @@ class Dataset(object):
         #conll_lines = build_conll_lines(
         #    conll_client.annotate(node.text), new_parses, note_id, parent, root)
         conll_lines = build_conll_lines(
-            conll_client.annotate(node.text), None, note_id, parent, root,
-            no_parse)
-        f.write("\n".join(conll_lines))
-
+            conll_text, None, note_id, parent, root, no_parse)
+        writer.write(note_id, text_hashes[note_id],
+            "\n".join(conll_lines) + "\n")
+        if (i + 1) % MANIFEST_SAVE_INTERVAL == 0:
+          writer.save()
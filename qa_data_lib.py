@@ -0,0 +1,54 @@
+import gzip
+import json
+
+import conll_lib
+
+
+def get_qa_filename(output_prefix, conference, split, compress=False):
+  filename = "_".join([output_prefix + "qaPairs", conference, split + ".jsonl"])
+  return filename + ".gz" if compress else filename
+
+
+class QaPairsWriter(object):
+  """Writes QA data as JSON Lines, gzipped if the filename ends in .gz.
+
+  The first line holds the conference and split; each later line holds the
+  nodes, questions and answers of one forum, so a file can be written and
+  read one forum at a time.
+  """
+
+  def __init__(self, filename, conference, split):
+    opener = gzip.open if filename.endswith(".gz") else open
+    self.f = opener(filename, 'wt')
+    self._write_line({"conference": conference, "split": split})
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def _write_line(self, obj):
+    self.f.write(json.dumps(obj) + "\n")
+
+  def write_forum(self, forum_id, nodes, questions, answers):
+    self._write_line({"forum": forum_id, "nodes": nodes,
+      "questions": questions, "answers": answers})
+
+  def close(self):
+    self.f.close()
+
+
+class QaPairsReader(object):
+  """Reads a file written by QaPairsWriter, one forum at a time."""
+
+  def __init__(self, filename):
+    self.lines = conll_lib.iter_file_lines(filename)
+    header = json.loads(next(self.lines))
+    self.conference = header["conference"]
+    self.split = header["split"]
+
+  def __iter__(self):
+    for line in self.lines:
+      if line.strip():
+        yield json.loads(line)
@@ -0,0 +1,129 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import time
+
+import openreview
+
+
+def get_snapshot_path(snapshot_dir, conference, split, forum_ids):
+  """Snapshot files are addressed by the set of forums they hold."""
+  digest = hashlib.sha1(
+      "\n".join(sorted(forum_ids)).encode("utf-8")).hexdigest()[:12]
+  return os.path.join(snapshot_dir,
+      "_".join([conference, split, digest]) + ".json.gz")
+
+
+def get_note_counts(snapshot_dir, conference):
+  """Counts the notes of every forum in a conference's snapshots."""
+  note_counts = {}
+  pattern = os.path.join(snapshot_dir, conference + "_*.json.gz")
+  for path in sorted(glob.glob(pattern)):
+    for forum_id, entry in ForumSnapshot(path).forums.items():
+      note_counts[forum_id] = len(entry["notes"])
+  return note_counts
+
+
+def get_max_tmdate(notes):
+  return max((note.tmdate or 0 for note in notes), default=0)
+
+
+class ForumSnapshot(object):
+  """Notes for one conference split, keyed by forum id.
+
+  Each forum entry records the notes as returned by the client, the largest
+  tmdate among them and the time at which they were fetched.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.forums = {}
+    self.dirty = False
+    if os.path.exists(path):
+      with gzip.open(path, 'rt') as f:
+        self.forums = json.loads(f.read())["forums"]
+
+  def __contains__(self, forum_id):
+    return forum_id in self.forums
+
+  def __len__(self):
+    return len(self.forums)
+
+  def is_stale(self, forum_id, tmdate=None, max_age=None):
+    """A forum is stale if missing, too old, or if its submission was
+    modified after capture. Replies do not change the submission's tmdate,
+    so only max_age makes new replies show up."""
+    if forum_id not in self.forums:
+      return True
+    entry = self.forums[forum_id]
+    if tmdate is not None and tmdate > entry["tmdate"]:
+      return True
+    if max_age is not None and time.time() - entry["fetched"] > max_age:
+      return True
+    return False
+
+  def get_notes(self, forum_id):
+    return [openreview.Note.from_json(note_json)
+        for note_json in self.forums[forum_id]["notes"]]
+
+  def get_submission_notes(self):
+    """The root note of every forum, i.e. the submission itself."""
+    submissions = []
+    for forum_id, entry in self.forums.items():
+      for note_json in entry["notes"]:
+        if note_json["id"] == forum_id:
+          submissions.append(openreview.Note.from_json(note_json))
+    return submissions
+
+  def add_forum(self, forum_id, notes):
+    self.forums[forum_id] = {
+        "tmdate": get_max_tmdate(notes),
+        "fetched": time.time(),
+        "notes": [note.to_json() for note in notes],
+        }
+    self.dirty = True
+
+  def save(self):
+    if not self.dirty:
+      return
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    temp_path = self.path + ".tmp"
+    with gzip.open(temp_path, 'wt') as f:
+      f.write(json.dumps({"forums": self.forums}, separators=(",", ":")))
+    os.replace(temp_path, self.path)
+    self.dirty = False
+
+
+class SnapshotClient(object):
+  """Offline stand-in for openreview.Client backed by forum snapshots.
+
+  Only the get_notes queries made by this pipeline are supported: all notes
+  of a forum, or the submissions of an invitation.
+  """
+
+  def __init__(self, snapshots):
+    self.snapshots = list(snapshots)
+
+  def _find_snapshot(self, forum_id):
+    for snapshot in self.snapshots:
+      if forum_id in snapshot:
+        return snapshot
+    raise KeyError("Forum {0} is not in any snapshot".format(forum_id))
+
+  def get_notes(self, forum=None, invitation=None, offset=None, limit=None,
+      **kwargs):
+    if forum is not None:
+      notes = self._find_snapshot(forum).get_notes(forum)
+    else:
+      notes = [note
+          for snapshot in self.snapshots
+          for note in snapshot.get_submission_notes()
+          if invitation is None or note.invitation == invitation]
+    start = offset or 0
+    if limit is None:
+      return notes[start:]
+    return notes[start:start + limit]
@@ -0,0 +1,133 @@
+import contextlib
+import itertools
+import re
+
+# Either backend's annotate(text) returns CoreNLP-style JSON: a list of
+# sentences, each with tokens carrying the word and its character offsets in
+# UTF-16 code units.
+CORENLP, FAST = "corenlp", "fast"
+BACKENDS = [CORENLP, FAST]
+
+ABBREVIATIONS = ("al cf eq eqs etc fig figs resp sec vs approx appx dr jr mr"
+    " mrs ms prof ref refs tab viz").split()
+# These may also end a sentence, if the next token is capitalized
+FINAL_ABBREVIATIONS = set(["etc.", "al."])
+
+BRACKETS = {"(": "-LRB-", ")": "-RRB-", "[": "-LSB-", "]": "-RSB-",
+    "{": "-LCB-", "}": "-RCB-"}
+QUOTES = {"“": "``", "”": "''", "‘": "`", "’": "'"}
+
+TOKEN_RE = re.compile(r"""
+    (?:https?://|www\.)[^\s<>"]*[^\s<>".,;:!?)\]}']  # URL
+  | [\w.+-]+@[\w-]+(?:\.[\w-]+)+                    # Email address
+  | (?:[^\W\d_]\.){2,}                              # Initialisms, e.g. i.e.
+  | (?i:(?:""" + "|".join(ABBREVIATIONS) + r""")\.)(?!\w)
+  | \d+(?:[.,:/]\d+)*                               # Numbers
+  | \.\.\.+ | --+ | [?!]+
+  | \w+(?=[nN]['’][tT]\b)                      # do|n't
+  | [nN]['’][tT]\b
+  | (?<=\w)['’](?:[sSdDmM]|re|RE|ve|VE|ll|LL)\b  # Clitics
+  | \w+(?:[-/&]\w+|['’](?!(?:[sSdDmM]|re|RE|ve|VE|ll|LL)\b)\w+)*
+  | \S
+  """, re.VERBOSE)
+
+# A sentence ends after one of these, along with any closing punctuation
+BOUNDARY_TOKENS = set([".", "?", "!"])
+BOUNDARY_FOLLOWERS = set(["''", "'", "-RRB-", "-RSB-", "-RCB-"])
+PARAGRAPH_BREAK_RE = re.compile(r"\n[^\S\n]*\n")
+
+
+def get_utf16_offsets(text):
+  """Maps each string index (and the end) to its UTF-16 code unit offset."""
+  if text.isascii():
+    return None
+  return [0] + list(itertools.accumulate(
+    2 if ord(char) > 0xFFFF else 1 for char in text))
+
+
+def normalize(word, open_quote):
+  """The PTB form of a token, as CoreNLP writes it in the word field."""
+  if word in BRACKETS:
+    return BRACKETS[word]
+  if word == '"':
+    return "``" if open_quote else "''"
+  if word in QUOTES:
+    return QUOTES[word]
+  return word.replace("’", "'")
+
+
+def is_boundary(word):
+  return word in BOUNDARY_TOKENS or (len(word) > 1 and set(word) <= set("?!"))
+
+
+class FastTokenizer(object):
+  """In-process stand-in for a CoreNLP client running tokenize and ssplit.
+
+  Tokens follow PTB conventions closely enough that sentence boundaries, and
+  in particular sentences ending in a question mark, agree with CoreNLP on
+  review text. As with ssplit.newlineIsSentenceBreak=two, blank lines end
+  sentences.
+  """
+
+  def annotate(self, text):
+    offsets = get_utf16_offsets(text)
+    paragraph_breaks = [match.start()
+        for match in PARAGRAPH_BREAK_RE.finditer(text)]
+
+    sentences = []
+    tokens = []
+    ended = False
+    open_quote = True
+    paragraph = 0
+    for match in TOKEN_RE.finditer(text):
+      start, end = match.span()
+      new_paragraph = False
+      while (paragraph < len(paragraph_breaks)
+          and paragraph_breaks[paragraph] < start):
+        paragraph += 1
+        new_paragraph = True
+        open_quote = True
+      word = normalize(match.group(), open_quote)
+      if match.group() == '"':
+        open_quote = not open_quote
+
+      if tokens and (new_paragraph
+          or ended and word not in BOUNDARY_FOLLOWERS
+          or tokens[-1]["word"] in FINAL_ABBREVIATIONS and word[0].isupper()):
+        sentences.append({"index": len(sentences), "tokens": tokens})
+        tokens = []
+        ended = False
+      ended = is_boundary(word) or (ended and word in BOUNDARY_FOLLOWERS)
+      tokens.append({
+          "index": len(tokens) + 1,
+          "word": word,
+          "originalText": match.group(),
+          "characterOffsetBegin": offsets[start] if offsets else start,
+          "characterOffsetEnd": offsets[end] if offsets else end,
+          })
+    if tokens:
+      sentences.append({"index": len(sentences), "tokens": tokens})
+    return {"sentences": sentences}
+
+
+def make_tokenize_client(backend, **corenlp_kwargs):
+  """A client for the given backend; CoreNLP keyword arguments are ignored by
+  the fast backend."""
+  if backend == FAST:
+    return FastTokenizer()
+  elif backend == CORENLP:
+    import corenlp
+    return corenlp.CoreNLPClient(**corenlp_kwargs)
+  else:
+    raise ValueError("Unknown tokenizer backend: {0}".format(backend))
+
+
+@contextlib.contextmanager
+def get_tokenize_client(backend, **corenlp_kwargs):
+  """A client for the given backend, for use in a with statement."""
+  client = make_tokenize_client(backend, **corenlp_kwargs)
+  if backend == FAST:
+    yield client
+  else:
+    with client:
+      yield client